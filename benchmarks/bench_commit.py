@@ -0,0 +1,42 @@
+# Run the batched commit pipeline against a fake Route53 client.
+#   python benchmarks/bench_commit.py --changes 5000 --latency 0.2
+
+import argparse
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+os.environ["AWS_HOSTED_ZONE_ID"] = "ZBENCHMARK"
+
+import r53_record_cli  # noqa: E402
+from fake_route53 import FakeRoute53Client, generate_zone  # noqa: E402
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark committing changes")
+    parser.add_argument("--changes", type=int, default=5000)
+    parser.add_argument("--latency", type=float, default=0.1, help="Seconds per fake API call")
+    parser.add_argument("--throttle-rate", type=float, default=0.0, help="Fraction of calls that are throttled")
+    parser.add_argument("--insync-after", type=int, default=2, help="get_change polls before a batch is INSYNC")
+    parser.add_argument("--workers", type=int, default=r53_record_cli.COMMIT_WORKERS)
+    parser.add_argument("--rate", type=float, default=r53_record_cli.API_RATE)
+    args = parser.parse_args()
+
+    records = generate_zone(count=args.changes)
+    client = FakeRoute53Client(records, latency=args.latency, throttle_rate=args.throttle_rate, insync_after=args.insync_after)
+    changes = [{"Action": "UPSERT", "ResourceRecordSet": dict(record, TTL=60)} for record in records]
+
+    def progress(result):
+        print("batch={0} changes={1} status={2} change_id={3} error={4}".format(result["batch"], len(result["changes"]), result["status"], result["change_id"], result["error"]))
+
+    start = time.perf_counter()
+    results = r53_record_cli.commit_changes(client, "ZBENCHMARK", changes, progress=progress, workers=args.workers,
+                                            limiter=r53_record_cli.RateLimiter(args.rate))
+    elapsed = time.perf_counter() - start
+    print("batches={0} insync={1} calls={2} seconds={3:.3f}".format(
+        len(results), sum(result["status"] == "INSYNC" for result in results), client.calls, elapsed))
+
+
+if __name__ == "__main__":
+    main()
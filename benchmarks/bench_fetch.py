@@ -0,0 +1,36 @@
+# Compare the serial page walk with the sharded parallel fetch against a fake Route53 client.
+#   python benchmarks/bench_fetch.py --pages 40 --latency 0.2
+
+import argparse
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+os.environ["AWS_HOSTED_ZONE_ID"] = "ZBENCHMARK"
+
+import r53_record_cli  # noqa: E402
+from fake_route53 import FakeRoute53Client, generate_zone  # noqa: E402
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark zone fetching")
+    parser.add_argument("--pages", type=int, default=20, help="Number of 300 record pages in the zone")
+    parser.add_argument("--latency", type=float, default=0.1, help="Seconds per fake API call")
+    parser.add_argument("--throttle-rate", type=float, default=0.0, help="Fraction of calls that are throttled")
+    parser.add_argument("--workers", type=int, default=r53_record_cli.FETCH_WORKERS)
+    parser.add_argument("--shards", type=int, default=r53_record_cli.FETCH_SHARDS)
+    args = parser.parse_args()
+
+    records = generate_zone(count=args.pages * int(r53_record_cli.PAGE_SIZE))
+    for label, workers, shards in (("serial", 1, 1), ("sharded", args.workers, args.shards)):
+        client = FakeRoute53Client(records, latency=args.latency, throttle_rate=args.throttle_rate)
+        start = time.perf_counter()
+        fetched = r53_record_cli.fetch_zone_records(client, "ZBENCHMARK", workers=workers, shards=shards)
+        elapsed = time.perf_counter() - start
+        assert fetched == client.zone_records(), "{0} fetch returned records out of order or incomplete".format(label)
+        print("{0:8} records={1} calls={2} seconds={3:.3f}".format(label, len(fetched), sum(client.calls.values()), elapsed))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,88 @@
+# Memory held by a loaded RecordSet and the load and filter times, compared with keeping a dict and a Record
+# per zone record plus per-record indexes, which is how records were held before RecordStore. The load times
+# include the tracemalloc overhead, use run_benchmarks.py for timings.
+#   python benchmarks/bench_memory.py --records 100000
+
+import argparse
+import gc
+import json
+import os
+import sys
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+os.environ["AWS_HOSTED_ZONE_ID"] = "ZBENCHMARK"
+
+import r53_record_cli  # noqa: E402
+from fake_route53 import generate_zone  # noqa: E402
+
+
+# The dict per record layout: the zone dicts, a Record object per dict and tuple indexes by name and policy
+class LegacyRecord:
+    __slots__ = ("original_data", "updated_data", "zone_id")
+
+    def __init__(self, data, zone_id):
+        self.original_data = data
+        self.updated_data = {}
+        self.zone_id = zone_id
+
+
+def legacy_load(zone):
+    records = [LegacyRecord(data, "ZBENCHMARK") for data in zone]
+    name_index, policy_index = {}, {}
+    for record in records:
+        name_index.setdefault(record.original_data["Name"], []).append(record)
+        policy_index.setdefault(r53_record_cli.get_routing_policy(record.original_data), []).append(record)
+    return records, name_index, {policy: tuple(records) for policy, records in policy_index.items()}
+
+
+# A RecordSet that is given its records instead of fetching them
+class LoadedRecordSet(r53_record_cli.RecordSet):
+    def load_cached_records(self, background=True):
+        return True
+
+
+def store_load(zone):
+    recordset = LoadedRecordSet(zone_ids=["ZBENCHMARK"], use_cache=False, background=False)
+    recordset.load_record_list({"ZBENCHMARK": zone})
+    return recordset
+
+
+# The zone is decoded from json like an API response or the cache, and only what the load keeps is counted
+def measure(load, blob):
+    gc.collect()
+    tracemalloc.start()
+    zone = json.loads(blob)
+    start = time.perf_counter()
+    loaded = load(zone)
+    elapsed = time.perf_counter() - start
+    del zone
+    gc.collect()
+    held = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    return loaded, elapsed, held
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark RecordSet memory use")
+    parser.add_argument("--records", type=int, default=100000)
+    parser.add_argument("--weighted", type=float, default=0.4, help="Fraction of records in weighted sets")
+    parser.add_argument("--latency-share", type=float, default=0.2, help="Fraction of records in latency sets")
+    args = parser.parse_args()
+
+    blob = json.dumps(generate_zone(count=args.records, weighted=args.weighted, latency=args.latency_share))
+    for label, load in (("legacy", legacy_load), ("store", store_load)):
+        loaded, elapsed, held = measure(load, blob)
+        print("{0:8} records={1} load_seconds={2:.3f} held_mb={3:.1f}".format(label, args.records, elapsed, held / 1024 / 1024))
+        del loaded
+
+    recordset = store_load(json.loads(blob))
+    start = time.perf_counter()
+    recordset.filter_records("Weight", "*a*")
+    recordset.filter_records("All", "~^[0-9]")
+    print("filter   seconds={0:.3f} matched={1}".format(time.perf_counter() - start, len(recordset.filtered_records)))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,78 @@
+# Table build time and peak memory for the Record views, compared with the old deepcopy based Record.
+#   python benchmarks/bench_record.py --records 30000
+
+import argparse
+import copy
+import os
+import sys
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+os.environ["AWS_HOSTED_ZONE_ID"] = "ZBENCHMARK"
+
+import r53_record_cli  # noqa: E402
+from fake_route53 import generate_zone  # noqa: E402
+
+
+# The Record implementation before it was moved to __slots__ and read-only views
+class LegacyRecord:
+    def __init__(self, data):
+        self.updated_data = {}
+        for k, v in data.items():
+            self.__dict__.update({k: v})
+
+    def update(self, field, value):
+        if field in self.__dict__:
+            self.updated_data[field] = value
+
+    def get_original_record(self):
+        original_data = copy.deepcopy(self.__dict__)
+        original_data.pop("updated_data")
+        return original_data
+
+    def get_updated_record(self):
+        updated_record = copy.deepcopy(self.__dict__)
+        for field in self.updated_data:
+            updated_record[field] = self.updated_data[field]
+        updated_record.pop("updated_data")
+        return updated_record
+
+
+def legacy_records(raw_records):
+    return [LegacyRecord(data) for data in raw_records]
+
+
+def store_records(raw_records):
+    store = r53_record_cli.RecordStore(["ZBENCHMARK"], {"ZBENCHMARK": raw_records})
+    return [r53_record_cli.Record(store, position) for position in range(len(store))]
+
+
+def measure(display, build, raw_records):
+    tracemalloc.start()
+    start = time.perf_counter()
+    records = build(raw_records)
+    for record in records[::10]:
+        record.update("TTL", 60)
+    display.create_table(records, "all")
+    display.create_table(records, "all", updated_records=True)
+    elapsed = time.perf_counter() - start
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return elapsed, peak
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark record table builds")
+    parser.add_argument("--records", type=int, default=30000)
+    args = parser.parse_args()
+
+    raw_records = generate_zone(count=args.records)
+    display = r53_record_cli.Display()
+    for label, build in (("legacy", legacy_records), ("record", store_records)):
+        elapsed, peak = measure(display, build, raw_records)
+        print("{0:8} records={1} seconds={2:.3f} peak_mb={3:.1f}".format(label, args.records, elapsed, peak / 1024 / 1024))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,60 @@
+# Import time of r53_record_cli (via python -X importtime) and time until the main menu is drawn
+# while the zone is still being fetched from a slow fake Route53 client.
+#   python benchmarks/bench_startup.py --latency 0.5 --pages 20
+
+import argparse
+import io
+import os
+import subprocess
+import sys
+import time
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+sys.path.insert(0, ROOT)
+os.environ["AWS_HOSTED_ZONE_ID"] = "ZBENCHMARK"
+
+
+def measure_import(module):
+    start = time.perf_counter()
+    result = subprocess.run([sys.executable, "-X", "importtime", "-c", "import {0}".format(module)],
+                            cwd=ROOT, capture_output=True, text=True, check=True)
+    wall = time.perf_counter() - start
+    cumulative = 0
+    for line in result.stderr.splitlines(): # import time: self [us] | cumulative | imported package
+        parts = line.split("|")
+        if len(parts) == 3 and parts[2].strip() == module:
+            cumulative = int(parts[1])
+    return cumulative / 1e6, wall
+
+
+def measure_first_menu(latency, pages):
+    import r53_record_cli
+    from fake_route53 import FakeRoute53Client, generate_zone
+
+    records = generate_zone(count=pages * int(r53_record_cli.PAGE_SIZE))
+    r53_record_cli.get_client = lambda: FakeRoute53Client(records, latency=latency)
+    start = time.perf_counter()
+    r53_record_cli.display = r53_record_cli.Display(file=io.StringIO(), width=120, height=40)
+    recordset = r53_record_cli.RecordSet(use_cache=False)
+    r53_record_cli.display.update_screen(r53_record_cli.get_menu_table(recordset))
+    first_menu = time.perf_counter() - start
+    recordset.wait_for_records()
+    loaded = time.perf_counter() - start
+    return first_menu, loaded
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark startup")
+    parser.add_argument("--latency", type=float, default=0.2, help="Seconds per fake API call")
+    parser.add_argument("--pages", type=int, default=10, help="Number of 300 record pages in the zone")
+    args = parser.parse_args()
+
+    for module in ("r53_record_cli", "rich.console", "boto3"):
+        cumulative, wall = measure_import(module)
+        print("import {0:16} importtime_s={1:.3f} process_s={2:.3f}".format(module, cumulative, wall))
+    first_menu, loaded = measure_first_menu(args.latency, args.pages)
+    print("first_menu_s={0:.3f} records_loaded_s={1:.3f}".format(first_menu, loaded))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,182 @@
+# Local stand-in for the boto3 Route53 client used by the benchmarks.
+# Records are kept in Route53's list order and every call sleeps for `latency` seconds.
+
+import bisect
+import copy
+import random
+import string
+import threading
+import time
+
+from botocore.exceptions import ClientError
+
+
+def route53_order(record):
+    name = record["Name"].rstrip(".").lower()
+    return (tuple(reversed(name.split("."))), record["Type"], record.get("SetIdentifier", ""))
+
+
+REGIONS = ["us-east-1", "us-east-2", "us-west-2", "eu-west-1", "eu-central-1", "ap-southeast-2"]
+
+
+# A zone of `count` records. `weighted` and `latency` are the fractions of records that belong to weighted
+# and latency record sets (2-4 members each, some with health checks); the rest are simple A and CNAME records
+def generate_zone(zone_name="example.com.", count=1000, seed=1, weighted=0.0, latency=0.0):
+    rand = random.Random(seed)
+    records = [
+        {"Name": zone_name, "Type": "NS", "TTL": 172800, "ResourceRecords": [{"Value": "ns-1.awsdns-00.com."}]},
+        {"Name": zone_name, "Type": "SOA", "TTL": 900, "ResourceRecords": [{"Value": "ns-1.awsdns-00.com. awsdns-hostmaster.amazon.com. 1 7200 900 1209600 86400"}]},
+    ]
+    labels = set()
+    while len(records) < count:
+        label = "".join(rand.choice(string.ascii_lowercase + string.digits) for _ in range(rand.randint(4, 12)))
+        if label in labels:
+            continue
+        labels.add(label)
+        name = "{0}.{1}".format(label, zone_name)
+        policy = rand.random()
+        if policy < weighted:
+            ttl = rand.choice([30, 60, 300])
+            for region in rand.sample(REGIONS, rand.randint(2, 4)):
+                records.append({"Name": name, "Type": "CNAME", "SetIdentifier": region, "Weight": rand.choice([0, 10, 50, 100, 128, 255]), "TTL": ttl,
+                                "ResourceRecords": [{"Value": "{0}.{1}.elb.amazonaws.com".format(label, region)}]})
+        elif policy < weighted + latency:
+            for region in rand.sample(REGIONS, rand.randint(2, 3)):
+                record = {"Name": name, "Type": "A", "SetIdentifier": region, "Region": region,
+                          "AliasTarget": {"HostedZoneId": "Z35SXDOTRQ7X7K", "DNSName": "{0}-{1}.elb.amazonaws.com.".format(label, region), "EvaluateTargetHealth": True}}
+                if rand.random() < 0.5:
+                    record["HealthCheckId"] = "{0:08x}-0000-4000-8000-{1:012x}".format(rand.getrandbits(32), rand.getrandbits(48))
+                records.append(record)
+        elif rand.random() < 0.8:
+            records.append({"Name": name, "Type": "A", "TTL": 300,
+                            "ResourceRecords": [{"Value": "10.0.{0}.{1}".format(rand.randint(0, 255), rand.randint(1, 254))}]})
+        else:
+            records.append({"Name": name, "Type": "CNAME", "TTL": 300, "ResourceRecords": [{"Value": "{0}.cdn.example.net".format(label)}]})
+    records = records[:count]
+    records.sort(key=route53_order)
+    return records
+
+
+class FakeRoute53Client:
+    def __init__(self, records=None, zone_name="example.com.", zone_id="ZBENCHMARK", latency=0.0, throttle_rate=0.0, insync_after=1, seed=1):
+        self.zones = {}
+        self.latency = latency
+        self.throttle_rate = throttle_rate
+        self.rand = random.Random(seed)
+        self.lock = threading.Lock()
+        self.calls = {}
+        self.insync_after = insync_after # get_change polls before a change reports INSYNC
+        self.changes = {}
+        self.health_checks = {} # created for every HealthCheckId in the zones added
+        if records is not None:
+            self.add_zone(zone_id, zone_name, records)
+
+    def add_zone(self, zone_id, zone_name, records):
+        records = sorted(records, key=route53_order)
+        self.zones[zone_id] = {"name": zone_name, "records": records, "keys": [route53_order(r) for r in records]}
+        for record in records:
+            if record.get("HealthCheckId"):
+                self.health_checks.setdefault(record["HealthCheckId"], {"Id": record["HealthCheckId"], "CallerReference": record["HealthCheckId"], "HealthCheckVersion": 1,
+                                                                        "HealthCheckConfig": {"Type": "HTTPS", "Inverted": False, "Disabled": False}})
+
+    def zone_records(self, zone_id="ZBENCHMARK"):
+        return self.zones[zone_id]["records"]
+
+    def _call(self, operation):
+        with self.lock:
+            self.calls[operation] = self.calls.get(operation, 0) + 1
+            throttled = self.rand.random() < self.throttle_rate
+        time.sleep(self.latency)
+        if throttled:
+            raise ClientError({"Error": {"Code": "Throttling", "Message": "Rate exceeded"}}, operation)
+
+    def _zone(self, zone_id, operation):
+        zone_id = zone_id.split("/")[-1]
+        if zone_id not in self.zones:
+            raise ClientError({"Error": {"Code": "NoSuchHostedZone", "Message": zone_id}}, operation)
+        return self.zones[zone_id]
+
+    def list_hosted_zones(self, Marker=None, MaxItems="100"):
+        self._call("ListHostedZones")
+        zone_ids = sorted(self.zones)
+        position = zone_ids.index(Marker) if Marker else 0
+        page = zone_ids[position:position + int(MaxItems)]
+        resp = {"HostedZones": [{"Id": "/hostedzone/" + zone_id, "Name": self.zones[zone_id]["name"]} for zone_id in page], "IsTruncated": False}
+        if position + int(MaxItems) < len(zone_ids):
+            resp.update({"IsTruncated": True, "NextMarker": zone_ids[position + int(MaxItems)]})
+        return resp
+
+    def get_hosted_zone(self, Id):
+        self._call("GetHostedZone")
+        return {"HostedZone": {"Id": Id, "Name": self._zone(Id, "GetHostedZone")["name"]}}
+
+    def list_resource_record_sets(self, HostedZoneId, StartRecordName=".", StartRecordType=None, StartRecordIdentifier=None, MaxItems="300"):
+        self._call("ListResourceRecordSets")
+        zone = self._zone(HostedZoneId, "ListResourceRecordSets")
+        records = zone["records"]
+        start = (route53_order({"Name": StartRecordName, "Type": ""})[0], StartRecordType or "", StartRecordIdentifier or "")
+        position = bisect.bisect_left(zone["keys"], start)
+        page = records[position:position + int(MaxItems)]
+        resp = {"ResourceRecordSets": page, "IsTruncated": False, "MaxItems": MaxItems}
+        if position + int(MaxItems) < len(records):
+            next_record = records[position + int(MaxItems)]
+            resp.update({"IsTruncated": True, "NextRecordName": next_record["Name"], "NextRecordType": next_record["Type"]})
+            if next_record.get("SetIdentifier"):
+                resp["NextRecordIdentifier"] = next_record["SetIdentifier"]
+        return resp
+
+    def change_resource_record_sets(self, HostedZoneId, ChangeBatch):
+        self._call("ChangeResourceRecordSets")
+        zone = self._zone(HostedZoneId, "ChangeResourceRecordSets")
+        size = chars = 0
+        for change in ChangeBatch["Changes"]:
+            values = [v["Value"] for v in change["ResourceRecordSet"].get("ResourceRecords", [])]
+            multiplier = 2 if change["Action"] == "UPSERT" else 1
+            size += multiplier * max(1, len(values))
+            chars += multiplier * sum(len(value) for value in values)
+        if size > 1000 or chars > 32000:
+            raise ClientError({"Error": {"Code": "InvalidChangeBatch", "Message": "Batch too large"}}, "ChangeResourceRecordSets")
+        with self.lock:
+            change_id = "/change/C{0:08d}".format(len(self.changes) + 1)
+            self.changes[change_id] = {"polls": 0, "batch": ChangeBatch}
+            for change in ChangeBatch["Changes"]:
+                record = change["ResourceRecordSet"]
+                key = route53_order(record)
+                position = bisect.bisect_left(zone["keys"], key)
+                if position < len(zone["keys"]) and zone["keys"][position] == key:
+                    zone["records"][position] = record
+                else:
+                    zone["keys"].insert(position, key)
+                    zone["records"].insert(position, record)
+        return {"ChangeInfo": {"Id": change_id, "Status": "PENDING"}, "ResponseMetadata": {"HTTPStatusCode": 200}}
+
+    def get_change(self, Id):
+        self._call("GetChange")
+        with self.lock:
+            change = self.changes[Id]
+            change["polls"] += 1
+            status = "INSYNC" if change["polls"] >= self.insync_after else "PENDING"
+        return {"ChangeInfo": {"Id": Id, "Status": status}}
+
+    def list_health_checks(self, Marker=None, MaxItems="100"):
+        self._call("ListHealthChecks")
+        with self.lock:
+            health_check_ids = sorted(self.health_checks)
+            position = health_check_ids.index(Marker) if Marker else 0
+            page = [copy.deepcopy(self.health_checks[health_check_id]) for health_check_id in health_check_ids[position:position + int(MaxItems)]]
+        resp = {"HealthChecks": page, "IsTruncated": False, "MaxItems": MaxItems}
+        if position + int(MaxItems) < len(health_check_ids):
+            resp.update({"IsTruncated": True, "NextMarker": health_check_ids[position + int(MaxItems)]})
+        return resp
+
+    def update_health_check(self, HealthCheckId, HealthCheckVersion=None, **config):
+        self._call("UpdateHealthCheck")
+        with self.lock:
+            if HealthCheckId not in self.health_checks:
+                raise ClientError({"Error": {"Code": "NoSuchHealthCheck", "Message": HealthCheckId}}, "UpdateHealthCheck")
+            health_check = self.health_checks[HealthCheckId]
+            if HealthCheckVersion is not None and HealthCheckVersion != health_check["HealthCheckVersion"]:
+                raise ClientError({"Error": {"Code": "HealthCheckVersionMismatch", "Message": HealthCheckId}}, "UpdateHealthCheck")
+            health_check["HealthCheckConfig"].update(config)
+            health_check["HealthCheckVersion"] += 1
+            return {"HealthCheck": copy.deepcopy(health_check)}
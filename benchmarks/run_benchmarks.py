@@ -0,0 +1,125 @@
+# Time the main stages (refresh, filter, changeset load, table build, commit) on synthetic zones and compare
+# them with a saved baseline. Exits 1 when a stage is slower than the baseline by more than the tolerance.
+#   python benchmarks/run_benchmarks.py --sizes 1000,10000,100000 --save benchmarks/baseline.json
+#   python benchmarks/run_benchmarks.py --compare benchmarks/baseline.json --tolerance 0.5
+
+import argparse
+import gc
+import io
+import json
+import os
+import platform
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+os.environ["AWS_HOSTED_ZONE_ID"] = "ZBENCHMARK"
+os.environ.setdefault("R53_API_RATE", "0") # the commit rate limiter would otherwise dominate the commit stage
+
+import r53_record_cli  # noqa: E402
+from fake_route53 import FakeRoute53Client, generate_zone  # noqa: E402
+
+STAGES = ["refresh", "filter", "changeset_load", "table_build", "commit"]
+MIN_SECONDS = 0.02 # stages faster than this are too noisy to compare
+
+
+# Fastest of several runs, with garbage collection off while timing like timeit
+def best_of(repeat, function):
+    best = None
+    for _ in range(repeat):
+        gc.collect()
+        gc.disable()
+        try:
+            start = time.perf_counter()
+            function()
+            elapsed = time.perf_counter() - start
+        finally:
+            gc.enable()
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def run_size(size, args, workdir):
+    records = generate_zone(count=size, weighted=args.weighted, latency=args.latency_share)
+    client = FakeRoute53Client(records, latency=args.latency, throttle_rate=args.throttle_rate)
+    r53_record_cli.get_client = lambda: client
+    timings = {}
+    recordsets = []
+
+    def refresh():
+        recordsets.append(r53_record_cli.RecordSet(zone_ids=["ZBENCHMARK"], use_cache=False, background=False))
+    timings["refresh"] = best_of(args.repeat, refresh)
+    recordset = recordsets[-1]
+
+    def filter_records():
+        recordset.filter_records("Weight")
+        recordset.filter_records("Weight", "*a*")
+        recordset.filter_records("All", "~^[0-9]")
+        recordset.filter_records("Region")
+    timings["filter"] = best_of(args.repeat, filter_records)
+
+    # A changeset draining a tenth of the weighted records
+    weighted = recordset.select_records("weighted")
+    changeset = os.path.join(workdir, "changeset-{0}.jsonl".format(size))
+    r53_record_cli.write_changeset(changeset, (dict(record.to_dict(updated=False), Weight=0) for record in weighted[::10]))
+
+    def changeset_load():
+        for record in recordset.get_updated_records():
+            record.reset()
+        r53_record_cli.load_records(recordset, changeset) # stages the matched records
+    timings["changeset_load"] = best_of(args.repeat, changeset_load)
+
+    display = r53_record_cli.Display(file=io.StringIO(), width=160)
+    timings["table_build"] = best_of(args.repeat, lambda: display.create_table(weighted, "weighted"))
+
+    # Only the first run commits anything, the records are reset once their batches are accepted
+    timings["commit"] = best_of(1, lambda: recordset.commit_staged_records(wait=False))
+    return timings
+
+
+def compare(results, baseline, tolerance):
+    regressions = []
+    for size, timings in results.items():
+        for stage, seconds in timings.items():
+            base = baseline.get(size, {}).get(stage)
+            if base is None or max(seconds, base) < MIN_SECONDS:
+                continue
+            if seconds > base * (1 + tolerance):
+                regressions.append("{0} records {1}: {2:.3f}s vs baseline {3:.3f}s (+{4:.0%})".format(size, stage, seconds, base, seconds / base - 1))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark RecordSet and Display stages on synthetic zones")
+    parser.add_argument("--sizes", default="1000,10000,100000", help="Comma separated zone sizes")
+    parser.add_argument("--weighted", type=float, default=0.4, help="Fraction of records in weighted sets")
+    parser.add_argument("--latency-share", type=float, default=0.2, help="Fraction of records in latency sets")
+    parser.add_argument("--latency", type=float, default=0.0, help="Seconds per fake API call")
+    parser.add_argument("--throttle-rate", type=float, default=0.0, help="Fraction of calls that are throttled")
+    parser.add_argument("--repeat", type=int, default=3, help="Runs per stage, the fastest is kept")
+    parser.add_argument("--save", help="Write the results to this baseline file")
+    parser.add_argument("--compare", help="Baseline file to compare the results with")
+    parser.add_argument("--tolerance", type=float, default=0.5, help="Allowed slowdown before a stage counts as a regression")
+    args = parser.parse_args()
+
+    results = {}
+    with tempfile.TemporaryDirectory() as workdir:
+        for size in [int(size) for size in args.sizes.split(",")]:
+            results[str(size)] = timings = run_size(size, args, workdir)
+            print("{0:>7} records  ".format(size) + "  ".join("{0}={1:.3f}s".format(stage, timings[stage]) for stage in STAGES))
+
+    if args.save:
+        with open(args.save, "w") as f:
+            json.dump({"python": platform.python_version(), "machine": platform.machine(), "results": results}, f, indent=2, sort_keys=True)
+    if args.compare:
+        with open(args.compare) as f:
+            regressions = compare(results, json.load(f)["results"], args.tolerance)
+        for regression in regressions:
+            print("REGRESSION " + regression)
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
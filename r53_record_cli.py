@@ -1,60 +1,266 @@
 #!/usr/bin/python3
 
 import argparse
-import boto3
-from botocore.exceptions import ClientError
+import bisect
+import contextlib
+import csv
+import io
+import itertools
+import fnmatch
+import functools
 import json
 import logging
+import math
 import sys
 import time
 import os
-import copy
-from rich.columns import Columns
-from rich import print as rprint
-from rich.table import Table
-from rich.console import Console, ScreenContext, RenderGroup
-from rich.screen import Screen
-from rich.prompt import Prompt, Confirm, IntPrompt
-from rich.style import Style
-from rich.color import Color
-from rich.layout import Layout
-from rich.panel import Panel
-from rich.traceback import install
-install()
+from array import array
+from collections import ChainMap, Counter, deque
+from collections.abc import Mapping, Sequence
+from types import MappingProxyType
+import random
+import re
+import sqlite3
+import threading
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+# boto3 and rich are imported where they are first needed to keep startup fast, see benchmarks/bench_startup.py
 
 logger = logging.getLogger(__name__)
 logger.setLevel(logging.INFO)
-formatter = logging.Formatter('%(asctime)s - %(levelname)s - %(message)s')
-fh = logging.FileHandler('logs/r53_updates.log')
-fh.setLevel(logging.INFO)
-fh.setFormatter(formatter)
-logger.addHandler(fh)
 
 
-HOSTED_ZONE_ID=os.getenv('AWS_HOSTED_ZONE_ID')
-if not HOSTED_ZONE_ID:
-    print("'AWS_HOSTED_ZONE_ID' env variable must be set")
-    sys.exit(1)
+HOSTED_ZONE_IDS=[zone_id.strip() for zone_id in os.getenv('AWS_HOSTED_ZONE_ID', '').split(',') if zone_id.strip()] # comma separated for several zones
 os.environ['PAGER'] = 'less -r'
 
-class Display(Console):
+ZONE_WORKERS=int(os.getenv('R53_ZONE_WORKERS', '4')) # hosted zones fetched or committed concurrently
+FETCH_WORKERS=int(os.getenv('R53_FETCH_WORKERS', '8')) # concurrent list_resource_record_sets calls
+FETCH_SHARDS=int(os.getenv('R53_FETCH_SHARDS', '16')) # number of name space shards per zone
+API_MAX_ATTEMPTS=int(os.getenv('R53_API_MAX_ATTEMPTS', '8'))
+API_MAX_BACKOFF=20
+PAGE_SIZE="300"
+THROTTLE_CODES=("Throttling", "ThrottlingException", "PriorRequestNotComplete", "RequestLimitExceeded")
+SHARD_ALPHABET="0123456789abcdefghijklmnopqrstuvwxyz"
+COMMIT_WORKERS=int(os.getenv('R53_COMMIT_WORKERS', '4')) # change batches submitted concurrently
+API_RATE=float(os.getenv('R53_API_RATE', '5')) # Route53 allows 5 requests per second per account
+RETRY_MODE=os.getenv('R53_RETRY_MODE', 'adaptive') # botocore retry mode, adaptive also slows the client down once it is throttled
+RETRY_ATTEMPTS=int(os.getenv('R53_RETRY_ATTEMPTS', '5')) # botocore attempts per call, call_with_backoff retries throttles on top
+MAX_POOL_CONNECTIONS=int(os.getenv('R53_MAX_POOL_CONNECTIONS', str(max(10, ZONE_WORKERS * FETCH_WORKERS)))) # enough for every fetch worker
+CONNECT_TIMEOUT=float(os.getenv('R53_CONNECT_TIMEOUT', '5'))
+READ_TIMEOUT=float(os.getenv('R53_READ_TIMEOUT', '30'))
+CHANGE_POLL_TIMEOUT=int(os.getenv('R53_CHANGE_POLL_TIMEOUT', '300')) # seconds to wait for batches to reach INSYNC
+MAX_BATCH_CHANGES=1000 # ResourceRecord elements per change batch, UPSERTs count twice
+MAX_BATCH_CHARS=32000 # characters of record values per change batch, UPSERTs count twice
+CACHE_DIR=os.getenv('R53_CACHE_DIR', 'cache')
+CACHE_TTL=int(os.getenv('R53_CACHE_TTL', '300')) # seconds a cached snapshot is trusted without refetching
+NOOP_MAX_AGE=int(os.getenv('R53_NOOP_MAX_AGE', '30')) # seconds loaded records are trusted to skip no-op changes, older ones are checked live
+UNDO_STEPS=int(os.getenv('R53_UNDO_STEPS', '100')) # staged edits that can be undone
+PROFILE=os.getenv('R53_PROFILE', '') # 'metrics' writes stage timings and API counts to logs/, 'cprofile' adds a cProfile dump (--profile)
+LIVE_TICK=float(os.getenv('R53_LIVE_TICK', '5')) # seconds between live view polls and redraws
+LIVE_RATE=float(os.getenv('R53_LIVE_RATE', '1')) # Route53 requests per second the live view may use
+LIVE_BAR_WIDTH=20
+MAX_WEIGHT=255
+AUDIT_LOG=os.getenv('R53_AUDIT_LOG', 'logs/r53_audit.jsonl') # json lines, one per committed change and batch
+AUDIT_MAX_BYTES=int(os.getenv('R53_AUDIT_MAX_BYTES', str(10 * 1024 * 1024))) # the audit log is rotated at this size
+AUDIT_BACKUPS=int(os.getenv('R53_AUDIT_BACKUPS', '5')) # rotated audit logs kept, <log>.1 is the newest
+
+display = None # set to a Display for interactive use; batch commands run without one
+metrics = None # set to a Metrics when profiling
+
+
+# Audit lines are put on a queue and written by a listener thread, so a large commit doesn't block the menu on
+# file writes. The listener is stopped when the program exits, which writes whatever is still queued
+def configure_logging():
+    import atexit
+    import queue
+    from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler
+    os.makedirs(os.path.dirname(AUDIT_LOG) or '.', exist_ok=True)
+    fh = RotatingFileHandler(AUDIT_LOG, maxBytes=AUDIT_MAX_BYTES, backupCount=AUDIT_BACKUPS, delay=True) # the file is opened on the first commit
+    fh.setFormatter(logging.Formatter('%(message)s'))
+    audit_queue = queue.SimpleQueue()
+    listener = QueueListener(audit_queue, fh)
+    logger.addHandler(QueueHandler(audit_queue))
+    listener.start()
+    atexit.register(listener.stop)
+
+
+# One json line in the audit log. It's encoded here, so records changed after the call can't change the line
+def audit(event, **fields):
+    logger.info(json.dumps({"time": round(time.time(), 3), "event": event, **fields}, default=str))
+
+
+# One client, with its connection pool, shared by every fetch, commit and poll. boto3 clients are thread safe
+_client = None
+_client_lock = threading.Lock()
+
+
+def get_client():
+    global _client
+    with _client_lock:
+        if _client is None:
+            import boto3
+            from botocore.config import Config
+            config = Config(retries={"mode": RETRY_MODE, "max_attempts": RETRY_ATTEMPTS}, max_pool_connections=MAX_POOL_CONNECTIONS,
+                            connect_timeout=CONNECT_TIMEOUT, read_timeout=READ_TIMEOUT)
+            _client = boto3.session.Session().client('route53', config=config)
+            _client.meta.events.register('needs-retry', count_request) # sees every HTTP attempt, including botocore's retries
+        return _client
+
+
+# API call counts for the run, to help size the worker and rate settings. calls are made by call_with_backoff,
+# requests are HTTP attempts seen by botocore, so requests - calls is how often botocore retried
+api_stats = {"calls": 0, "requests": 0, "throttled": 0, "errors": 0, "backoff_retries": 0}
+api_stats_lock = threading.Lock()
+
+
+def count_api(name):
+    with api_stats_lock:
+        api_stats[name] += 1
+
+
+def count_request(response=None, caught_exception=None, **kwargs):
+    count_api("requests")
+    if caught_exception is not None:
+        count_api("errors")
+    elif response:
+        error_code = response[1].get("Error", {}).get("Code")
+        if error_code in THROTTLE_CODES:
+            count_api("throttled")
+        elif error_code:
+            count_api("errors")
+
+
+def get_api_stats():
+    with api_stats_lock:
+        stats = dict(api_stats)
+    stats["retries"] = max(0, stats["requests"] - stats["calls"]) if stats["requests"] else 0
+    return stats
+
+
+# botocore's ClientError carries the AWS error code, anything else has none
+def get_error_code(e):
+    return (getattr(e, "response", None) or {}).get("Error", {}).get("Code") # some botocore errors have response=None
+
+
+class QuietStatus:
+    def update(self, *args, **kwargs):
+        pass
+
+
+# Spinner while waiting on AWS when there is a display, nothing for batch commands
+def get_status(message):
+    if display:
+        return display.status(message, spinner="dots")
+    return contextlib.nullcontext(QuietStatus())
+
+
+# Stage timings, API call counts and latencies, and record counts for a run. Stages can nest (commit includes
+# waiting for INSYNC), and stages run from several threads at once add up their time
+class Metrics:
     def __init__(self):
-        super().__init__()
+        self.started = time.time()
+        self.stages = {} # name -> {"count", "seconds", "max_seconds"}
+        self.api_calls = {} # operation -> {"count", "seconds", "max_seconds", "errors", "throttled"}
+        self.counts = {}
+        self.lock = threading.Lock()
+
+    def add_time(self, timings, name, seconds, error_code=None):
+        with self.lock:
+            timing = timings.setdefault(name, {"count": 0, "seconds": 0.0, "max_seconds": 0.0})
+            timing["count"] += 1
+            timing["seconds"] += seconds
+            timing["max_seconds"] = max(timing["max_seconds"], seconds)
+            if error_code:
+                timing["errors"] = timing.get("errors", 0) + 1
+                if error_code in THROTTLE_CODES:
+                    timing["throttled"] = timing.get("throttled", 0) + 1
+
+    def count(self, name, value=1):
+        with self.lock:
+            self.counts[name] = self.counts.get(name, 0) + value
+
+    def to_dict(self):
+        with self.lock:
+            return {"started": self.started, "seconds": time.time() - self.started, "stages": self.stages, "api_calls": self.api_calls, "counts": self.counts, "client": get_api_stats()}
+
+    def write(self, filename):
+        with open(filename, "w") as f:
+            json.dump(self.to_dict(), f, indent=2, sort_keys=True)
+
+
+# Time a stage of the run when profiling, nothing otherwise
+@contextlib.contextmanager
+def timed(name):
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        if metrics:
+            metrics.add_time(metrics.stages, name, time.perf_counter() - started)
+
+
+# timed() for functions that are a stage as a whole
+def profiled(name):
+    def decorator(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            with timed(name):
+                return function(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def count_metric(name, value=1):
+    if metrics:
+        metrics.count(name, value)
+
+
+# Wraps a rich Console, which is created along with the Display so batch commands never import rich
+class Display:
+    def __init__(self, **console_args):
+        from rich.console import Console
+        self.console = Console(**console_args)
         self.all_records_header = {'Index':'center', 'Name':'right', 'ResourceRecords':'left', 'AliasTarget':'left', 'Type':'center', 'TTL':'center', 'Weight':'center'}
         self.weighted_records_header = {'Index':'center', 'Name':'right', 'ResourceRecords':'left', 'Weight':'center'}
         self.latency_records_header = {'Index':'center', 'Name':'right', 'ResourceRecords':'left', 'AliasTarget':'left', 'Type':'center', 'TTL':'center', 'Weight':'center'}
         self.screen = ""
 
+    def __getattr__(self, name): # print, status, clear, size, ... come from the console
+        return getattr(self.console, name)
+
+    # Only the rows that fit on screen are turned into a table, so paging cost depends on the terminal height
     def display_paginated(self, recordset, subtype=""):
-        table = self.create_table(recordset.filtered_records, subtype)
-        self.screen = ScreenContext(self, hide_cursor=True)
-        with self.screen:
-            with self.pager(styles=True):
-                with self.status("Building Records Table", spinner="dots"):
-                    self.print(table)
-        self.screen = ""
+        from rich.prompt import Prompt
+        records = recordset.filtered_records
+        offset = 0
+        while True:
+            page_size = self.get_page_size()
+            offset = max(0, min(offset, len(records) - page_size))
+            table = self.create_table(records[offset:offset + page_size], subtype, start_index=offset, single_line=True)
+            table.caption = "Rows {0}-{1} of {2}".format(offset, min(offset + page_size, len(records)) - 1, len(records))
+            self.update_screen(table)
+            choice = Prompt.ask("'Enter' next page, 'p' previous, '<index>' jump to record, 't' top, 'b' bottom, 'q' quit", default="", show_default=False).strip()
+            if choice == "q":
+                break
+            elif choice == "":
+                if offset + page_size >= len(records):
+                    break
+                offset += page_size
+            elif choice == "p":
+                offset -= page_size
+            elif choice == "t":
+                offset = 0
+            elif choice == "b":
+                offset = len(records)
+            elif choice.isdigit():
+                offset = int(choice)
+        self.end_screen()
+
+    def get_page_size(self):
+        return max(1, self.size.height - 9) # title, header and borders, caption and the prompt
 
     def split_display(self, left_display, right_display):
+        from rich.layout import Layout
         layout = Layout()
         layout.split(Layout(name="upper"), Layout(name="lower"))
         layout['upper'].size = 5
@@ -67,15 +273,23 @@ class Display(Console):
 
         self.update_screen(layout)
 
-    def create_table(self, recordset, subtype, updated_records=False, bgcolors=[236,232]):
+    @profiled("render")
+    def create_table(self, recordset, subtype, updated_records=False, bgcolors=[236,232], start_index=0, single_line=False):
+        from rich.color import Color
+        from rich.style import Style
+        from rich.table import Table
         title = "{0} Records List".format(subtype.title())
         table = Table(title=title)
         table_headers = getattr(self, subtype + "_records_header")
 
         for header, justify in table_headers.items():
-            table.add_column(header, justify=justify)
+            if single_line:
+                table.add_column(header, justify=justify, no_wrap=True, overflow="ellipsis")
+            else:
+                table.add_column(header, justify=justify)
 
-        count = 0
+        styles = [Style(bgcolor=Color.from_ansi(bgcolor)) for bgcolor in bgcolors] # one per color, not per row
+        count = start_index
         for record in recordset:
             if updated_records:
                 record = record.get_updated_record()
@@ -83,28 +297,69 @@ class Display(Console):
                 record = record.get_original_record()
             row_values = []
             for header in table_headers.keys():
+                value = record.get(header) if header != 'Index' else None # one lookup per cell, packed fields are unpacked once
                 if header == 'Index':
                     row_values.append(str(count))
-                elif record.get(header, None):
+                elif value:
                     if header == 'ResourceRecords':
-                        row_values.append(",".join([v['Value'] for v in record['ResourceRecords']]))
+                        row_values.append(",".join([v['Value'] for v in value]))
                     elif header == 'AliasTarget':
-                        row_values.append(record['AliasTarget']['DNSName'])
+                        row_values.append(value['DNSName'])
                     else:
-                        row_values.append(str(record[header]))
+                        row_values.append(str(value))
                 else:
                     row_values.append("")
-            if count % 2 == 0:
-                color = Color.from_ansi(bgcolors[0])
-            else:
-                color = Color.from_ansi(bgcolors[1])
-            table.add_row(*row_values, style=Style(bgcolor=color))
+            table.add_row(*row_values, style=styles[count % 2])
             
             count += 1
     
         return table
 
+    # The health check state of latency and failover records, staged updates shown as 'current -> staged'.
+    # Only the rows that fit on screen are built, the caption says how many records the actions apply to
+    def create_health_check_table(self, recordset, records):
+        from rich.table import Table
+
+        caption = "{0} of {1} records shown, {2} health check updates staged".format(min(len(records), self.get_page_size()), len(records), len(recordset.staged_health_checks))
+        table = Table(title="Latency and Failover Health Checks", caption=caption)
+        for header in ("Index", "Name", "SetIdentifier", "Region / Failover", "HealthCheckId", "Inverted", "Disabled"):
+            table.add_column(header)
+
+        for count, record in enumerate(records[:self.get_page_size()]):
+            config = recordset.health_checks.get(record.HealthCheckId, {}).get("HealthCheckConfig", {})
+            staged = recordset.staged_health_checks.get(record.HealthCheckId, {})
+            states = []
+            for field in ("Inverted", "Disabled"):
+                current = config.get(field, False)
+                if field in staged:
+                    states.append("[yellow]{0} -> {1}".format(current, staged[field]))
+                else:
+                    states.append("[red]True" if current else "False")
+            table.add_row(str(count), record.Name, record.get("SetIdentifier", ""), record.get("Region", record.get("Failover", "")), record.HealthCheckId, *states)
+        return table
+
+    # One row per staged record with the fields that would change and any drift since it was staged
+    def create_diff_table(self, diff):
+        from rich.table import Table
+
+        changed = sum(1 for entry in diff if entry["status"] == "changed")
+        drifted = sum(1 for entry in diff if entry["drift"])
+        caption = "{0} changes, {1} unchanged (skipped on commit), {2} drifted since staging".format(changed, len(diff) - changed, drifted)
+        table = Table(title="Staged Changes", caption=caption)
+        for header in ("Index", "Name", "SetIdentifier", "Field", "Live", "Staged", "Drift"):
+            table.add_column(header)
+
+        for count, entry in enumerate(diff):
+            record = entry["record"]
+            fields = entry["fields"] or {"": ("", "")}
+            drift = "\n".join("{0}: {1} -> {2}".format(field, old, new) for field, (old, new) in entry["drift"].items())
+            table.add_row(str(count), record.Name, record.get("SetIdentifier", ""), "\n".join(fields),
+                          "\n".join(str(old) for old, new in fields.values()), "\n".join(str(new) for old, new in fields.values()),
+                          "[red]" + drift if drift else "", style="dim" if entry["status"] == "unchanged" else "")
+        return table
+
     def new_screen(self):
+        from rich.screen import Screen
         self.set_alt_screen(enable=True)
         self.screen = Screen(style="")
 
@@ -119,156 +374,1630 @@ class Display(Console):
         self.screen = ""
 
 
+PACKED_FIELDS=("ResourceRecords", "AliasTarget") # stored as tuples by RecordStore
+NO_UPDATES=MappingProxyType({}) # shared by every Record without staged changes
+NOT_PACKED=object() # RecordStore.pack() result for values that are kept in extras
+
+
+# A column of repeated strings: each distinct value is stored once in the table, rows hold its position
+class CodedColumn:
+    def __init__(self):
+        self.table = []
+        self.codes = {} # value -> position in the table
+        self.rows = array("i") # -1 when the record has no value
+
+    def encode(self, value):
+        if value is None:
+            return -1
+        code = self.codes.get(value)
+        if code is None:
+            code = self.codes[value] = len(self.table)
+            self.table.append(value)
+        return code
+
+    def extend(self, values):
+        for value in dict.fromkeys(values):
+            self.encode(value)
+        codes = self.codes
+        self.rows.extend([codes[value] if value is not None else -1 for value in values])
+
+    def __getitem__(self, row):
+        code = self.rows[row]
+        return self.table[code] if code >= 0 else None
+
+    def __setitem__(self, row, value):
+        self.rows[row] = self.encode(value)
+
+
+class IntColumn:
+    def __init__(self):
+        self.rows = array("q") # -1 when the record has no value, Weight and TTL are never negative
+
+    def extend(self, values):
+        self.rows.extend([value if value is not None else -1 for value in values])
+
+    def __getitem__(self, row):
+        value = self.rows[row]
+        return value if value >= 0 else None
+
+    def __setitem__(self, row, value):
+        self.rows[row] = value if value is not None else -1
+
+
+# The records of every loaded zone in columns, one row per record with the zones one after another in
+# RecordSet.zone_ids order. A dict per record is most of the memory at 100k+ records, so records with the same
+# name share one string, repeated strings go through CodedColumn, Weight and TTL are integer arrays and
+# ResourceRecords and AliasTarget are packed into tuples. Fields without a column (GeoLocation, MultiValueAnswer, ...) or values that don't fit
+# one are kept as they are in `extras`. get_data() builds the record's dict again when it's needed
+class RecordStore:
+    def __init__(self, zone_ids=(), zone_records=None):
+        self.zone_ids = list(zone_ids)
+        self.zone_offsets = {} # zone_id -> row of the zone's first record
+        self.names = [] # the Name column
+        self.types = CodedColumn()
+        self.set_identifiers = CodedColumn()
+        self.columns = {"Name": self.names, "Type": self.types, "SetIdentifier": self.set_identifiers, "Weight": IntColumn(), "Region": CodedColumn(),
+                        "Failover": CodedColumn(), "TTL": IntColumn(), "ResourceRecords": [], "AliasTarget": [], "HealthCheckId": []}
+        self.extras = {} # row -> {field: value}
+        for zone_id in self.zone_ids:
+            self.zone_offsets[zone_id] = len(self.names)
+            self.extend((zone_records or {}).get(zone_id, []))
+        self.zone_starts = [self.zone_offsets[zone_id] for zone_id in self.zone_ids]
+
+    def __len__(self):
+        return len(self.names)
+
+    # The column value for a field, NOT_PACKED if it has to go to extras
+    def pack(self, field, value):
+        if value is None:
+            return None
+        if field in ("Weight", "TTL"):
+            return value if type(value) is int and value >= 0 else NOT_PACKED
+        if field == "ResourceRecords": # a single value is kept as the string, the common case is checked first
+            if type(value) is list and len(value) == 1 and type(value[0]) is dict and value[0].keys() == {"Value"} and type(value[0]["Value"]) is str:
+                return value[0]["Value"]
+            if type(value) is not list or not all(type(item) is dict and item.keys() == {"Value"} and type(item["Value"]) is str for item in value):
+                return NOT_PACKED
+            return tuple(item["Value"] for item in value)
+        if field == "AliasTarget":
+            if type(value) is not dict or value.keys() != {"HostedZoneId", "DNSName", "EvaluateTargetHealth"}:
+                return NOT_PACKED
+            return (sys.intern(value["HostedZoneId"]), value["DNSName"], value["EvaluateTargetHealth"])
+        if type(value) is not str:
+            return NOT_PACKED
+        return value
+
+    def unpack(self, field, value):
+        if field == "ResourceRecords":
+            return [{"Value": value}] if type(value) is str else [{"Value": item} for item in value]
+        if field == "AliasTarget":
+            return {"HostedZoneId": value[0], "DNSName": value[1], "EvaluateTargetHealth": value[2]}
+        return value
+
+    # Columns are filled a zone at a time, which is several times faster than going record by record
+    def extend(self, records):
+        start = len(self.names)
+        extras = {} # offset in records -> fields kept in extras
+        fields = self.columns.keys()
+        for offset in [offset for offset, data in enumerate(records) if not data.keys() <= fields]:
+            extras[offset] = {field: value for field, value in records[offset].items() if field not in self.columns}
+        for field, column in self.columns.items():
+            values = [data.get(field) for data in records]
+            if field in PACKED_FIELDS:
+                packed = [self.pack(field, value) if value is not None else None for value in values]
+            elif field in ("Weight", "TTL"): # the rest are checked here in bulk, the same way pack() does
+                packed = [value if value is None or (type(value) is int and value >= 0) else NOT_PACKED for value in values]
+            else:
+                packed = [value if value is None or type(value) is str else NOT_PACKED for value in values]
+            if NOT_PACKED in packed:
+                for offset in [offset for offset, value in enumerate(packed) if value is NOT_PACKED]:
+                    extras.setdefault(offset, {})[field] = values[offset]
+                    packed[offset] = None
+            if field == "Name": # records in a set share one name string
+                names = {}
+                packed = [names.setdefault(value, value) if value is not None else None for value in packed]
+            column.extend(packed)
+        for offset, fields in extras.items():
+            self.extras[start + offset] = fields
+
+    def set_data(self, row, data):
+        extras = {field: value for field, value in data.items() if field not in self.columns}
+        for field, column in self.columns.items():
+            value = self.pack(field, data.get(field))
+            if value is NOT_PACKED:
+                extras[field], value = data[field], None
+            column[row] = value
+        if extras:
+            self.extras[row] = extras
+        else:
+            self.extras.pop(row, None)
+
+    def get(self, row, field, default=None):
+        column = self.columns.get(field)
+        if column is not None:
+            value = column[row]
+            if value is not None:
+                return self.unpack(field, value) if field in PACKED_FIELDS else value
+        extras = self.extras.get(row)
+        return extras.get(field, default) if extras else default
+
+    def has(self, row, field):
+        column = self.columns.get(field)
+        if column is not None and column[row] is not None:
+            return True
+        return field in self.extras.get(row, ())
+
+    def get_data(self, row): # a new dict each time, the columns aren't affected by changes to it
+        data = {}
+        for field, column in self.columns.items():
+            value = column[row]
+            if value is not None:
+                data[field] = value
+        for field in PACKED_FIELDS:
+            if field in data:
+                data[field] = self.unpack(field, data[field])
+        if row in self.extras:
+            data.update(self.extras[row])
+        return data
+
+    def key(self, row): # record_key() without building the dict, called for every record lookup
+        if row in self.extras:
+            return record_key(self.get_data(row))
+        return (self.names[row], self.types[row], self.set_identifiers[row])
+
+    def zone_id(self, row):
+        if len(self.zone_ids) == 1:
+            return self.zone_ids[0]
+        return self.zone_ids[bisect.bisect_right(self.zone_starts, row) - 1]
+
+    def zone_records(self, zone_id): # the zone's records as returned by AWS, e.g. for the cache
+        start = self.zone_offsets[zone_id]
+        end = self.zone_starts[self.zone_ids.index(zone_id) + 1] if zone_id != self.zone_ids[-1] else len(self.names)
+        return [self.get_data(row) for row in range(start, end)]
+
+
+# A zone record plus an overlay of staged changes. The original data is read from the RecordSet's RecordStore,
+# so Records only exist while something uses them (see RecordSet.record_at) and nothing is copied until
+# original_data or to_dict() is used
 class Record:
-    def __init__(self, data):
-        self.updated_data = {} # add an updated_data field to house the updated fields and values
-        self._parse_record(data)
-    
-    def _parse_record(self, data): # add each field of record as attribute of class object
-        for k,v in data.items():
-            self.__dict__.update({k:v})
+    __slots__ = ("store", "position", "updated_data", "owner")
+
+    def __init__(self, store, position, owner=None):
+        self.store = store
+        self.position = position # row in the store
+        self.updated_data = NO_UPDATES # updated fields and values, replaced rather than changed in place
+        self.owner = owner # the RecordSet tracking which records are staged
+
+    def __getattr__(self, field): # expose the record's fields as attributes, e.g. record.Name
+        if field in Record.__slots__:
+            raise AttributeError(field)
+        if not self.store.has(self.position, field):
+            raise AttributeError(field)
+        return self.store.get(self.position, field)
+
+    def get(self, field, default=None):
+        return self.store.get(self.position, field, default)
+
+    @property
+    def original_data(self):
+        return self.store.get_data(self.position)
+
+    @property
+    def zone_id(self):
+        return self.store.zone_id(self.position)
+
+    @property
+    def identity(self): # unique across every loaded hosted zone
+        return (self.zone_id,) + self.store.key(self.position)
+
+    # The Record the owner keeps for this row when another Record was made for it and staged, or the one for
+    # the same record after a reload. Edits go through it, so a row only ever has one set of staged fields
+    def staged_record(self):
+        if self.owner:
+            if self.store is not self.owner.store:
+                return self.owner.get_record(self.identity) or self
+            record = self.owner.staged.get(self.position)
+            if record is not None:
+                return record
+        return self
 
     def reset(self):
-        self.updated_data = {}
+        self.set_updated_data({})
 
     def update(self, field, value): # add the updated field and value to the updated fields dict
-        if field in self.__dict__:
-            self.updated_data[field] = value
+        if self.store.has(self.position, field):
+            updated_data = dict(self.staged_record().updated_data)
+            updated_data[field] = value
+            self.set_updated_data(updated_data)
+
+    # Staged fields are only replaced, never changed in place, so the owner can keep them for undo and redo
+    def set_updated_data(self, updated_data, track=True):
+        record = self.staged_record()
+        if record is not self:
+            self.updated_data = updated_data
+            record.set_updated_data(updated_data, track)
+            return
+        previous, self.updated_data = self.updated_data, updated_data
+        if self.owner and self.store is self.owner.store: # a record that is no longer loaded isn't staged
+            self.owner.record_staged(self, previous, track)
+
+    def get_original_record(self):
+        return RecordView(self.store, self.position)
+
+    def get_updated_record(self): # original fields overlaid with the updated values
+        if not self.updated_data:
+            return RecordView(self.store, self.position)
+        return MappingProxyType(ChainMap(self.updated_data, RecordView(self.store, self.position)))
+
+    def to_dict(self, updated=True): # plain dict for json or the AWS api
+        data = self.original_data
+        if updated:
+            data.update(self.updated_data)
+        return data
+
+
+# Read-only mapping over a record in a RecordStore, fields are read from the columns as they're looked up
+class RecordView(Mapping):
+    __slots__ = ("store", "row")
+
+    def __init__(self, store, row):
+        self.store = store
+        self.row = row
+
+    def __getitem__(self, field):
+        if not self.store.has(self.row, field):
+            raise KeyError(field)
+        return self.store.get(self.row, field)
+
+    def get(self, field, default=None):
+        return self.store.get(self.row, field, default)
+
+    def __contains__(self, field):
+        return self.store.has(self.row, field)
+
+    def __iter__(self):
+        return iter(self.store.get_data(self.row))
+
+    def __len__(self):
+        return len(self.store.get_data(self.row))
+
+
+# Records by position, e.g. a filter result. Only the positions are kept (an array, or a range for every
+# record), the Records are looked up when they are read
+class RecordList(Sequence):
+    def __init__(self, recordset, positions=()):
+        self.recordset = recordset
+        self.positions = positions
+
+    def __len__(self):
+        return len(self.positions)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return RecordList(self.recordset, self.positions[index])
+        return self.recordset.record_at(self.positions[index])
+
+    def __iter__(self):
+        record_at = self.recordset.record_at
+        for position in self.positions:
+            yield record_at(position)
+
+    def __add__(self, other):
+        return RecordList(self.recordset, array("i", itertools.chain(self.positions, other.positions)))
+
+
+# Spaces out calls shared between threads so they stay under the API's request rate
+class RateLimiter:
+    def __init__(self, rate=API_RATE):
+        self.interval = 1.0 / rate if rate > 0 else 0
+        self.next_call = 0
+        self.lock = threading.Lock()
+
+    def wait(self):
+        if not self.interval:
+            return
+        with self.lock:
+            now = time.monotonic()
+            delay = self.next_call - now
+            self.next_call = max(now, self.next_call) + self.interval
+        if delay > 0:
+            time.sleep(delay)
+
+
+# Retry throttled API calls with exponential backoff and jitter
+def call_with_backoff(method, limiter=None, **kwargs):
+    attempt = 0
+    while True:
+        if limiter:
+            limiter.wait()
+        started = time.perf_counter()
+        count_api("calls")
+        try:
+            response = method(**kwargs)
+            if metrics:
+                metrics.add_time(metrics.api_calls, getattr(method, "__name__", "call"), time.perf_counter() - started)
+            return response
+        except Exception as e:
+            if metrics:
+                metrics.add_time(metrics.api_calls, getattr(method, "__name__", "call"), time.perf_counter() - started, get_error_code(e) or type(e).__name__)
+            attempt += 1
+            if get_error_code(e) not in THROTTLE_CODES or attempt >= API_MAX_ATTEMPTS:
+                raise
+            count_api("backoff_retries")
+            time.sleep(min(API_MAX_BACKOFF, 0.1 * 2 ** attempt) * random.uniform(0.5, 1.0))
+
+
+# Route53 returns records sorted by name with the labels reversed (com.example.www) and escape codes decoded
+def route53_sort_key(name):
+    name = re.sub(r"\\(\d{3})", lambda m: chr(int(m.group(1), 8)), name.rstrip(".").lower())
+    return tuple(reversed(name.split(".")))
+
+
+# Split a zone's name space on the first character of the label below the apex
+def get_shard_starts(zone_name, shards):
+    shards = max(1, min(shards, len(SHARD_ALPHABET)))
+    step = len(SHARD_ALPHABET) / shards
+    starts = [zone_name] # the first shard also picks up the apex and names sorting before '0'
+    for i in range(1, shards):
+        starts.append("{0}.{1}".format(SHARD_ALPHABET[int(i * step)], zone_name))
+    return starts
+
+
+def get_next_page_args(resp):
+    page_args = {"StartRecordName": resp['NextRecordName']}
+    if resp.get('NextRecordType'):
+        page_args["StartRecordType"] = resp['NextRecordType']
+    if resp.get('NextRecordIdentifier'):
+        page_args["StartRecordIdentifier"] = resp['NextRecordIdentifier']
+    return page_args
+
+
+# Page through one shard until the next page would start in the following shard
+def fetch_shard(client, zone_id, page_args, stop=None):
+    records = []
+    while True:
+        resp = call_with_backoff(client.list_resource_record_sets, HostedZoneId=zone_id, MaxItems=PAGE_SIZE, **page_args)
+        records += resp['ResourceRecordSets']
+        if not resp.get('IsTruncated') or not resp.get('NextRecordName'):
+            return records
+        if stop and route53_sort_key(resp['NextRecordName']) >= stop:
+            return records
+        page_args = get_next_page_args(resp)
+
+
+# One set's records by record_key, read from where the set starts in the zone's record order
+def fetch_record_set(client, zone_id, name, record_type, limiter=None):
+    members = {}
+    page_args = {"StartRecordName": name, "StartRecordType": record_type}
+    while True:
+        resp = call_with_backoff(client.list_resource_record_sets, limiter, HostedZoneId=zone_id, MaxItems="100", **page_args)
+        for data in resp['ResourceRecordSets']:
+            if (data['Name'], data['Type']) != (name, record_type):
+                return members
+            members[record_key(data)] = data
+        if not resp.get('IsTruncated') or not resp.get('NextRecordName'):
+            return members
+        page_args = get_next_page_args(resp)
+
+
+# Zone ids are returned as '/hostedzone/<id>' by some calls
+def get_zone_id(zone_id):
+    return zone_id.split("/")[-1]
+
+
+def list_hosted_zones(client):
+    zones = []
+    page_args = {}
+    while True:
+        resp = call_with_backoff(client.list_hosted_zones, **page_args)
+        zones += resp['HostedZones']
+        if not resp.get('IsTruncated'):
+            return zones
+        page_args = {"Marker": resp['NextMarker']}
+
+
+# Fetch several hosted zones at once, each of them with its own sharded fetch
+def fetch_zones(client, zone_ids, workers=ZONE_WORKERS):
+    with timed("fetch"), ThreadPoolExecutor(max_workers=max(1, min(workers, len(zone_ids)))) as pool:
+        zone_records = dict(zip(zone_ids, pool.map(lambda zone_id: fetch_zone_records(client, zone_id), zone_ids)))
+    count_metric("records_fetched", sum(len(records) for records in zone_records.values()))
+    return zone_records
+
+
+def fetch_zone_records(client, zone_id, workers=FETCH_WORKERS, shards=FETCH_SHARDS):
+    # Small zones fit in a single page, so only fan out once the first page comes back truncated
+    first_page = call_with_backoff(client.list_resource_record_sets, HostedZoneId=zone_id, MaxItems=PAGE_SIZE, StartRecordName=".")
+    records = first_page['ResourceRecordSets']
+    if not first_page.get('IsTruncated') or not first_page.get('NextRecordName'):
+        return records
+    if workers <= 1 or shards <= 1:
+        return records + fetch_shard(client, zone_id, get_next_page_args(first_page))
+
+    zone_name = call_with_backoff(client.get_hosted_zone, Id=zone_id)['HostedZone']['Name']
+    starts = get_shard_starts(zone_name, shards)
+    stops = [route53_sort_key(start) for start in starts[1:]] + [None]
+    shard_args = [get_next_page_args(first_page)] + [{"StartRecordName": start} for start in starts[1:]]
+    if route53_sort_key(first_page['NextRecordName']) >= stops[0]: # the first page already ran past the first shard
+        shard_args[0] = None
+
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        futures = [pool.submit(fetch_shard, client, zone_id, page_args, stop) if page_args else None for page_args, stop in zip(shard_args, stops)]
+        shard_results = [future.result() if future else [] for future in futures]
+
+    # Shards overlap by at most one page at their boundaries, so keep the first copy of each record
+    seen = set()
+    merged = []
+    for record in records + [record for shard in shard_results for record in shard]:
+        key = record_key(record)
+        if key not in seen:
+            seen.add(key)
+            merged.append(record)
+    return merged
+
+
+def get_change_size(change):
+    record = change["ResourceRecordSet"]
+    values = [v["Value"] for v in record.get("ResourceRecords", [])]
+    multiplier = 2 if change["Action"] == "UPSERT" else 1
+    return multiplier * max(1, len(values)), multiplier * sum(len(value) for value in values)
+
+
+# Group changes into batches under Route53's per request limits, returning the positions of the changes in each batch
+def split_change_batches(changes, max_changes=MAX_BATCH_CHANGES, max_chars=MAX_BATCH_CHARS):
+    batches = []
+    batch = []
+    batch_changes = batch_chars = 0
+    for position, change in enumerate(changes):
+        size, chars = get_change_size(change)
+        if batch and (batch_changes + size > max_changes or batch_chars + chars > max_chars):
+            batches.append(batch)
+            batch = []
+            batch_changes = batch_chars = 0
+        batch.append(position)
+        batch_changes += size
+        batch_chars += chars
+    if batch:
+        batches.append(batch)
+    return batches
+
+
+# Problems with one change's record data that Route53 would reject its whole batch for, as (field, error) pairs.
+# The weighted set checks need the other records and are done by RecordSet.validate_staged
+def validate_record_data(data):
+    errors = []
+    weight = data.get("Weight")
+    if weight is not None and (type(weight) is not int or not 0 <= weight <= MAX_WEIGHT):
+        errors.append(("Weight", "weight {0!r} must be between 0-{1}".format(weight, MAX_WEIGHT)))
+    ttl = data.get("TTL")
+    if ttl is not None and (type(ttl) is not int or ttl < 0):
+        errors.append(("TTL", "TTL {0!r} must be a whole number of seconds".format(ttl)))
+    values = data.get("ResourceRecords")
+    if "AliasTarget" in data:
+        if values is not None or ttl is not None:
+            errors.append(("AliasTarget", "alias records can't have ResourceRecords or a TTL"))
+    elif not values:
+        errors.append(("ResourceRecords", "needs ResourceRecords or an AliasTarget"))
+    if values is not None:
+        if type(values) is not list or not all(type(value) is dict and type(value.get("Value")) is str for value in values):
+            errors.append(("ResourceRecords", "ResourceRecords must be a list of {'Value': <string>}"))
+        else:
+            size, chars = get_change_size({"Action": "UPSERT", "ResourceRecordSet": data})
+            if size > MAX_BATCH_CHANGES or chars > MAX_BATCH_CHARS:
+                errors.append(("ResourceRecords", "{0} values and {1} characters don't fit in one change batch ({2} and {3} at most)".format(
+                    size, chars, MAX_BATCH_CHANGES, MAX_BATCH_CHARS)))
+    return errors
+
+
+# Submit changes in batches on a rate limited thread pool, then poll until every batch is INSYNC.
+# progress(result) is called whenever a batch is submitted or changes state
+def commit_changes(client, zone_id, changes, comment="MTA Update", wait=True, progress=None, workers=COMMIT_WORKERS, limiter=None, poll_timeout=CHANGE_POLL_TIMEOUT):
+    limiter = limiter or RateLimiter()
+    batches = split_change_batches(changes)
+    results = []
+    for batch, positions in enumerate(batches):
+        results.append({"zone_id": zone_id, "batch": batch, "positions": positions, "changes": [changes[i] for i in positions],
+                        "change_id": None, "status": "QUEUED", "error": None, "submitted_at": None, "elapsed": None})
+
+    def submit(result):
+        change_batch = {"Comment": comment, "Changes": result["changes"]}
+        if len(results) > 1:
+            change_batch["Comment"] = "{0} ({1}/{2})".format(comment, result["batch"] + 1, len(results))
+        result["submitted_at"] = time.time()
+        try:
+            resp = call_with_backoff(client.change_resource_record_sets, limiter=limiter, HostedZoneId=zone_id, ChangeBatch=change_batch)
+            result["change_id"] = resp['ChangeInfo']['Id']
+            result["status"] = resp['ChangeInfo']['Status']
+        except Exception as e:
+            result["status"] = "FAILED"
+            result["error"] = str(e)
+        result["elapsed"] = time.time() - result["submitted_at"]
+        if progress:
+            progress(result)
+
+    with ThreadPoolExecutor(max_workers=max(1, workers)) as pool:
+        list(pool.map(submit, results))
+    if wait:
+        try:
+            wait_for_changes(client, results, limiter, progress, poll_timeout)
+        except Exception as e: # the batches were accepted, so their results are kept whatever goes wrong while polling
+            for result in results:
+                if result["status"] == "PENDING":
+                    result["error"] = str(e)
+    return results
+
+
+# API and network errors while polling are kept in the result's error and the change is polled again, until the timeout
+@profiled("wait_insync")
+def wait_for_changes(client, results, limiter=None, progress=None, timeout=CHANGE_POLL_TIMEOUT):
+    from botocore.exceptions import BotoCoreError
+    deadline = time.monotonic() + timeout
+    delay = 1
+    pending = [result for result in results if result["status"] == "PENDING"]
+    while pending:
+        for result in pending:
+            try:
+                resp = call_with_backoff(client.get_change, limiter=limiter, Id=result["change_id"])
+            except Exception as e:
+                if not get_error_code(e) and not isinstance(e, BotoCoreError):
+                    raise
+                result["error"] = str(e)
+                continue
+            if resp['ChangeInfo']['Status'] != result["status"]:
+                result["status"] = resp['ChangeInfo']['Status']
+                result["elapsed"] = time.time() - result["submitted_at"]
+                if progress:
+                    progress(result)
+        pending = [result for result in pending if result["status"] == "PENDING"]
+        if pending and time.monotonic() + delay > deadline:
+            for result in pending:
+                result["status"] = "TIMEOUT"
+                if progress:
+                    progress(result)
+            break
+        if pending:
+            time.sleep(delay)
+            delay = min(delay * 2, 15)
+    return results
 
-    def get_original_record(self): # return original data from self.__dict__ minus the updated_data dict
-        original_data = copy.deepcopy(self.__dict__)
+
+def list_health_checks(client):
+    health_checks = []
+    page_args = {}
+    while True:
+        resp = call_with_backoff(client.list_health_checks, MaxItems="1000", **page_args)
+        health_checks += resp['HealthChecks']
+        if not resp.get('IsTruncated'):
+            return health_checks
+        page_args = {"Marker": resp['NextMarker']}
+
+
+# Apply {HealthCheckId: {"Inverted": bool, "Disabled": bool}} updates in parallel under the rate limiter. The version
+# the health check was loaded at is passed along, so a health check changed by someone else since isn't overwritten
+def update_health_checks(client, updates, health_checks, workers=COMMIT_WORKERS, limiter=None, progress=None):
+    limiter = limiter or RateLimiter()
+
+    def update(health_check_id):
+        result = {"health_check_id": health_check_id, "changes": updates[health_check_id], "status": "UPDATED", "error": None, "health_check": None}
+        version = health_checks.get(health_check_id, {}).get("HealthCheckVersion")
+        version_args = {"HealthCheckVersion": version} if version else {}
         try:
-            original_data.pop("updated_data")
-        except NameError:
-            pass
-        return original_data
-
-    def get_updated_record(self): # return all fields with the updated values
-        updated_record = copy.deepcopy(self.__dict__)
-        for field in self.updated_data:
-            updated_record[field] = self.updated_data[field]
+            resp = call_with_backoff(client.update_health_check, limiter=limiter, HealthCheckId=health_check_id, **version_args, **updates[health_check_id])
+            result["health_check"] = resp['HealthCheck']
+        except Exception as e:
+            result["status"] = "FAILED"
+            result["error"] = str(e)
+        if progress:
+            progress(result)
+        return result
+
+    with timed("health_checks"), ThreadPoolExecutor(max_workers=max(1, workers)) as pool:
+        return list(pool.map(update, list(updates)))
+
+
+# Maps the fields filter_records is called with to the routing policy index
+FIELD_POLICIES={'Weight': 'weighted', 'Region': 'latency', 'Failover': 'failover', 'GeoLocation': 'geo', 'MultiValueAnswer': 'multivalue'}
+
+
+def get_routing_policy(data):
+    for field, policy in FIELD_POLICIES.items():
+        if field in data:
+            return policy
+    if "GeoProximityLocation" in data:
+        return "geo"
+    return "simple"
+
+
+# All record names joined into one newline separated string with the offset each name starts at.
+# Substring, glob and regex searches run over the joined string in C instead of looping over records in python
+class NameSearch:
+    def __init__(self, names):
+        self.names = names
+        self.blob = "\n".join(names)
+        self.offsets = []
+        offset = 0
+        for name in names:
+            self.offsets.append(offset)
+            offset += len(name) + 1
+
+    def _position(self, offset):
+        return bisect.bisect_right(self.offsets, offset) - 1
+
+    def find(self, substring):
+        positions = []
+        offset = self.blob.find(substring)
+        while offset != -1:
+            position = self._position(offset)
+            if substring in self.names[position]: # matches can't span names, but check in case the substring has a newline
+                positions.append(position)
+            if position + 1 >= len(self.offsets):
+                break
+            offset = self.blob.find(substring, self.offsets[position + 1])
+        return positions
+
+    # After each hit the search restarts at the next name, as a match that runs over a newline (e.g. [^.] or \s)
+    # would otherwise use up the start of the next name
+    def regex(self, pattern):
+        pattern = re.compile(pattern, re.MULTILINE)
+        positions = []
+        match = pattern.search(self.blob)
+        while match:
+            position = self._position(match.start())
+            if pattern.search(self.names[position]):
+                positions.append(position)
+            if position + 1 >= len(self.offsets):
+                break
+            match = pattern.search(self.blob, self.offsets[position + 1])
+        return positions
+
+    def glob(self, pattern):
+        # narrow down with the longest literal part of the pattern before matching the whole name. Bracket
+        # expressions ([ab], [!ab], []ab]) match one of their characters, so they are left out of the literal
+        literal = max(re.split(r"[*?\[\]]", re.sub(r"\[!?\]?[^\]]*\]", "*", pattern)), key=len)
+        candidates = self.find(literal) if literal else range(len(self.names))
+        return [position for position in candidates if fnmatch.fnmatchcase(self.names[position], pattern)]
+
+    # '~<regex>' is a regular expression, anything with * ? or [ is a glob and everything else a substring
+    def search(self, filter_string):
+        if filter_string.startswith("~"):
+            return self.regex(filter_string[1:])
+        if any(char in filter_string for char in "*?["):
+            return self.glob(filter_string)
+        return self.find(filter_string)
+
+
+# Positions of each value as arrays, for fields with a few distinct values (Type, routing policy). A pass
+# per value is faster than appending the positions one at a time
+def group_positions(values):
+    return {value: array("i", [position for position, other in enumerate(values) if other == value]) for value in dict.fromkeys(values) if value is not None}
+
+
+# Route53 guarantees Name + Type + SetIdentifier is unique within a hosted zone
+def record_key(data):
+    return (data.get("Name"), data.get("Type"), data.get("SetIdentifier"))
+
+
+def record_value_key(data):
+    if data.get("AliasTarget"):
+        values = (data["AliasTarget"].get("DNSName"),)
+    else:
+        values = tuple(v["Value"] for v in data.get("ResourceRecords", []))
+    return (data.get("Name"), data.get("Type"), values)
+
+
+# Fields of `new` that differ from `old`, as field -> (old value, new value)
+def diff_fields(old, new, fields=None):
+    if fields is None:
+        fields = [field for field in new if field != "HostedZoneId"]
+    return {field: (old.get(field), new.get(field)) for field in fields if old.get(field) != new.get(field)}
+
+
+# Compare the state we want a record in with its live data. `base` is the data the change was made
+# against; if the live record no longer matches it, the record drifted since the change was staged
+def get_diff_entry(record, desired, base=None):
+    live = record.original_data # one dict, as every field is compared
+    fields = diff_fields(live, desired)
+    drift = diff_fields(base, live, set(base) | set(live)) if base else {}
+    return {"status": "changed" if fields else "unchanged", "record": record, "desired": desired, "fields": fields, "drift": drift}
+
+
+# Keyed diff of desired records (e.g. a changeset) against the loaded zones: one index lookup per record,
+# so it runs in linear time. `base` maps record identities to the data the changes were made against
+def iter_diff(recordset, desired_records, base=None):
+    base = base or {}
+    for desired in desired_records:
+        matches = recordset.find_records(desired)
+        if len(matches) != 1:
+            yield {"status": "unmatched" if not matches else "ambiguous", "record": None, "desired": desired, "fields": {}, "drift": {}}
+        else:
+            yield get_diff_entry(matches[0], desired, base.get(matches[0].identity))
+
+
+# Snapshots of each hosted zone's records, stored as zlib compressed json in a local sqlite db
+class RecordCache:
+    def __init__(self, path=None):
+        self.path = path or os.path.join(CACHE_DIR, "records.db")
+
+    def _connect(self):
+        os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+        conn = sqlite3.connect(self.path)
+        conn.execute("CREATE TABLE IF NOT EXISTS snapshots (zone_id TEXT PRIMARY KEY, fetched_at REAL, change_id TEXT, records BLOB)")
+        return conn
+
+    def load(self, zone_id):
+        try:
+            conn = self._connect()
+            try:
+                row = conn.execute("SELECT fetched_at, change_id, records FROM snapshots WHERE zone_id = ?", (zone_id,)).fetchone()
+            finally:
+                conn.close()
+        except sqlite3.Error:
+            return None
+        if not row:
+            return None
+        fetched_at, change_id, records = row
+        return {"fetched_at": fetched_at, "change_id": change_id, "records": json.loads(zlib.decompress(records))}
+
+    def save(self, zone_id, records, fetched_at, change_id=None):
+        blob = zlib.compress(json.dumps(records, separators=(",", ":")).encode())
+        conn = self._connect()
         try:
-            updated_record.pop("updated_data")
-        except NameError:
-            pass
-        
+            with conn:
+                conn.execute("REPLACE INTO snapshots (zone_id, fetched_at, change_id, records) VALUES (?, ?, ?, ?)", (zone_id, fetched_at, change_id, blob))
+        finally:
+            conn.close()
 
-        return updated_record
 
 
 class RecordSet:
-    def __init__(self):
-        self.client = boto3.client('route53')
-        self.all_records_list = []
-        self.original_records = []
-        self.filtered_records = []
-        self.refresh_records()
-        self.create_objects()
-
-    def create_objects(self):
-        for record in self.all_records_list:
-            self.original_records.append(Record(record))
-
-    # This returns fast enough (~900 records right now) that we can call it without issues
-    def refresh_records(self, next_item=".", init=True):
-        with display.status("Fetching Records from AWS", spinner="dots"):
+    def __init__(self, zone_ids=None, use_cache=True, cache_ttl=CACHE_TTL, background=True):
+        self.zone_ids = [get_zone_id(zone_id) for zone_id in (zone_ids or HOSTED_ZONE_IDS)]
+        self.store = RecordStore()
+        self.original_records = RecordList(self)
+        self.filtered_records = RecordList(self)
+        self.type_index = {} # Type -> array of positions
+        self.policy_index = {} # routing policy (weighted, latency, failover, geo, ...) -> array of positions
+        self.name_index = {} # Name -> position of the first record with the name. Records are looked up by name
+        self.next_with_name = array("i") # position -> position of the next record with the same name, -1 for the last
+        self.name_search = NameSearch([])
+        self.cache = RecordCache() if use_cache else None
+        self.cache_ttl = cache_ttl
+        self.fetched_at = None
+        self.last_change_ids = {} # zone_id -> id of the last change committed to it
+        self.staged_bases = {} # identity -> record data a staged change was made against, if it has since changed in AWS
+        self.staged = {} # position -> Record, the staged records in the order they were first staged
+        self.history = [] # undo steps, each a list of (identity, staged fields before, staged fields after)
+        self.redo_steps = []
+        self.edit_step = None # the step being built by edit_group()
+        self.health_check_index = {} # HealthCheckId -> array of positions
+        self.health_checks = {} # HealthCheckId -> health check as returned by list_health_checks, loaded on first use
+        self.staged_health_checks = {} # HealthCheckId -> {"Inverted": bool, "Disabled": bool} to update
+        self.commit_jobs = []
+        self.in_flight = {} # identity -> staged changes a background commit job is submitting
+        self.refresh_thread = None
+        self.background_records = None
+        self.background_error = None
+        if self.load_cached_records(background):
+            return
+        if background: # let the menu come up while the zones are fetched
+            self.start_background_refresh()
+        else:
+            self.refresh_records()
+
+    @property
+    def client(self): # the shared client, created on first use
+        return get_client()
+
+    # The zone records are copied into a RecordStore, so the lists of dicts can be dropped once they're loaded
+    def load_record_list(self, zone_records):
+        self.staged = {}
+        with timed("index"):
+            self.store = RecordStore(self.zone_ids, zone_records)
+            self.original_records = RecordList(self, range(len(self.store)))
+            self.filtered_records = RecordList(self)
+            self.build_filter_indexes(zone_records)
+        count_metric("records_loaded", len(self.original_records))
+
+    # Show a cached snapshot straight away. Once it is older than the ttl it is revalidated,
+    # either in a background thread or (for unattended runs) before returning
+    def load_cached_records(self, background=True):
+        if not self.cache:
+            return False
+        with timed("cache_load"):
+            snapshots = {zone_id: self.cache.load(zone_id) for zone_id in self.zone_ids}
+        self.last_change_ids = {zone_id: snapshot["change_id"] for zone_id, snapshot in snapshots.items() if snapshot and snapshot["change_id"]}
+        if not all(snapshots.values()):
+            return False
+        fetched_at = min(snapshot["fetched_at"] for snapshot in snapshots.values()) # the set is as old as its oldest zone
+        if self.cache_age(fetched_at) > self.cache_ttl and not background:
+            return False
+        self.load_record_list({zone_id: snapshot["records"] for zone_id, snapshot in snapshots.items()})
+        self.fetched_at = fetched_at
+        if self.cache_age(self.fetched_at) > self.cache_ttl:
+            self.start_background_refresh()
+        return True
+
+    def cache_age(self, fetched_at=None):
+        return time.time() - (fetched_at if fetched_at is not None else self.fetched_at or 0)
+
+    @profiled("cache_save")
+    def save_cache(self):
+        if self.cache:
+            for zone_id in self.zone_ids:
+                self.cache.save(zone_id, self.store.zone_records(zone_id), self.fetched_at, self.last_change_ids.get(zone_id))
+
+    def start_background_refresh(self):
+        if self.refresh_thread and self.refresh_thread.is_alive():
+            return
+        self.refresh_thread = threading.Thread(target=self._background_fetch, daemon=True)
+        self.refresh_thread.start()
+
+    def _background_fetch(self):
+        try:
+            fetched_at = time.time()
+            self.background_records = (fetch_zones(self.client, self.zone_ids), fetched_at)
+        except Exception as e:
+            self.background_error = e
+
+    def is_refreshing(self):
+        return bool(self.refresh_thread and self.refresh_thread.is_alive())
+
+    def is_loaded(self):
+        return self.fetched_at is not None
+
+    # Block until there are records to work with. A cached snapshot is good enough, otherwise
+    # wait for the initial background fetch, falling back to a foreground fetch if it failed
+    def wait_for_records(self):
+        if self.is_loaded():
+            return
+        if self.is_refreshing():
+            with get_status("Fetching Records from AWS"):
+                self.refresh_thread.join()
+        if not self.apply_background_refresh():
+            self.refresh_records()
+
+    # Swap in records fetched in the background
+    def apply_background_refresh(self):
+        if not self.background_records:
+            return False
+        (zone_records, fetched_at), self.background_records = self.background_records, None
+        if self.fetched_at and fetched_at < self.fetched_at: # a foreground refresh already loaded newer records
+            return False
+        self.replace_records(zone_records, fetched_at)
+        return True
+
+    # Load freshly fetched records, carrying staged changes over to them. When a staged record changed in
+    # AWS since it was staged, the data it was staged against is kept in staged_bases to report the drift.
+    # Records a commit job is submitting are carried over too, so their edits are back if the job fails
+    def replace_records(self, zone_records, fetched_at):
+        staged = [(record.identity, record.updated_data, record.original_data) for record in self.staged.values()]
+        self.load_record_list(zone_records)
+        for identity, updated_data, staged_against in staged:
+            record = self.get_record(identity)
+            if record:
+                record.set_updated_data(updated_data, track=False)
+                if record.original_data != staged_against:
+                    self.staged_bases.setdefault(identity, staged_against)
+        self.fetched_at = fetched_at
+        self.save_cache()
+
+    # Indexes from field values to positions, built from the zone records in the order the store was
+    def build_filter_indexes(self, zone_records):
+        records = [data for zone_id in self.zone_ids for data in zone_records.get(zone_id, [])]
+        self.type_index = group_positions([data.get("Type") for data in records])
+        self.policy_index = group_positions([get_routing_policy(data) for data in records])
+        self.health_check_index = {}
+        for position, health_check_id in enumerate(self.store.columns["HealthCheckId"]):
+            if health_check_id:
+                self.health_check_index.setdefault(health_check_id, array("i")).append(position)
+        self.name_index = {}
+        self.next_with_name = array("i", [-1]) * len(self.store)
+        last_with_name = {}
+        for position, name in enumerate(self.store.names):
+            if name in last_with_name:
+                self.next_with_name[last_with_name[name]] = position
+            else:
+                self.name_index[name] = position
+            last_with_name[name] = position
+        self.name_search = NameSearch(self.store.names)
+
+    def get_name_positions(self, name):
+        positions = []
+        position = self.name_index.get(name, -1)
+        while position >= 0:
+            positions.append(position)
+            position = self.next_with_name[position]
+        return positions
+
+    # The Record for a position. Records are made when they are read and only the staged ones are kept,
+    # so a staged record is always the same object
+    def record_at(self, position):
+        record = self.staged.get(position)
+        if record is None:
+            record = Record(self.store, position, self)
+        return record
+
+    # Swap a record's data for what was committed. The key stays the same, so the indexes don't change
+    def replace_record_data(self, record, data):
+        self.store.set_data(record.position, data)
+
+    def get_record(self, identity):
+        zone_id, key = identity[0], identity[1:]
+        for position in self.get_name_positions(key[0]):
+            if self.store.key(position) == key and self.store.zone_id(position) == zone_id:
+                return self.record_at(position)
+        return None
+
+    # Look up the records a change applies to. SetIdentifier (or its absence) makes the key unique in a zone,
+    # so the values fallback is only used for change records that don't carry a SetIdentifier.
+    # A HostedZoneId field limits the match to that zone, otherwise every loaded zone is searched.
+    # Only the few records with the change's name are compared
+    def find_records(self, change_record):
+        positions = self.get_name_positions(change_record.get("Name"))
+        key = record_key(change_record)
+        matches = [position for position in positions if self.store.key(position) == key]
+        if not matches and "SetIdentifier" not in change_record:
+            value_key = record_value_key(change_record)
+            matches = [position for position in positions if record_value_key(self.store.get_data(position)) == value_key]
+        if change_record.get("HostedZoneId"):
+            zone_id = get_zone_id(change_record["HostedZoneId"])
+            matches = [position for position in matches if self.store.zone_id(position) == zone_id]
+        return [self.record_at(position) for position in matches]
+
+    # The record as written to changesets and batch command output, tagged with its zone when several are loaded
+    def export_record(self, record, updated=True):
+        data = record.to_dict(updated=updated)
+        if len(self.zone_ids) > 1:
+            data["HostedZoneId"] = record.zone_id
+        return data
+
+    def refresh_records(self):
+        with get_status("Fetching Records from AWS"):
             try:
-                self.all_records_list = []
-                self.original_records = []
-                self.filtered_records = []
-                resp = self.client.list_resource_record_sets(HostedZoneId=HOSTED_ZONE_ID, MaxItems="300", StartRecordName=next_item)
-                self.all_records_list += resp['ResourceRecordSets']
-                while resp.get('NextRecordName', None):
-                    next_item = resp['NextRecordName']
-                    resp = self.client.list_resource_record_sets(HostedZoneId=HOSTED_ZONE_ID, MaxItems="300", StartRecordName=next_item)
-                    self.all_records_list += resp['ResourceRecordSets']
-                if not init:
-                    self.create_objects()
-            except ClientError as e:
-                if e.response['Error']['Code'] == "AccessDenied":
-                    print('AccessDenied - check your AWS credentials')
+                fetched_at = time.time()
+                self.replace_records(fetch_zones(self.client, self.zone_ids), fetched_at)
+            except Exception as e:
+                if not get_error_code(e):
+                    raise
+                if get_error_code(e) == "AccessDenied":
+                    print('AccessDenied - check your AWS credentials', file=sys.stderr)
                     sys.exit(1)
                 else:
-                    print(e)
+                    print(e, file=sys.stderr)
                     sys.exit(1)
 
+    # Diff of every staged record against the loaded zone data, see get_diff_entry
+    @profiled("diff")
+    def diff_staged(self):
+        return [get_diff_entry(record, record.get_updated_record(), self.staged_bases.get(record.identity)) for record in self.get_updated_records()]
+
+    # Staged records that match what is already in AWS would be no-op UPSERTs, unstage them. The loaded records
+    # can be an older snapshot (e.g. from the cache), so unless they were fetched in the last `max_age` seconds
+    # the sets of the records that look unchanged are fetched live, and only records that still match are dropped
+    def drop_noop_changes(self, max_age=NOOP_MAX_AGE):
+        noops = [entry["record"] for entry in self.diff_staged() if entry["status"] == "unchanged"]
+        if noops and self.cache_age() > max_age:
+            limiter = RateLimiter()
+            live = {}
+            for set_key in {(record.zone_id, record.Name, record.Type) for record in noops}:
+                live.update({(set_key[0],) + key: data for key, data in fetch_record_set(self.client, *set_key, limiter=limiter).items()})
+            noops = [record for record in noops if record.identity in live and not diff_fields(live[record.identity], record.to_dict())]
+        for record in noops:
+            record.set_updated_data({}, track=False)
+        return noops
+
+    # Called by Record whenever its staged fields change
+    def record_staged(self, record, previous, track=True):
+        if record.updated_data:
+            self.staged[record.position] = record
+        elif self.staged.get(record.position) is record:
+            del self.staged[record.position]
+        if track and previous != record.updated_data:
+            entry = (record.identity, previous, record.updated_data)
+            if self.edit_step is not None:
+                self.edit_step.append(entry)
+            else:
+                self.add_history_step([entry])
+
+    def add_history_step(self, step):
+        self.history.append(step)
+        del self.history[:-UNDO_STEPS]
+        self.redo_steps = []
+
+    # Group the edits made inside the block into one undo step, e.g. a bulk weight change
+    @contextlib.contextmanager
+    def edit_group(self):
+        self.edit_step = []
+        try:
+            yield
+        finally:
+            step, self.edit_step = self.edit_step, None
+            if step:
+                self.add_history_step(step)
+
+    # Undo and redo put back the staged fields saved with each step. Records are looked up by identity,
+    # so the history survives reloads. Both return the number of records changed
+    def undo(self):
+        if not self.history:
+            return 0
+        step = self.history.pop()
+        self.redo_steps.append(step)
+        return self.restore_step([(identity, before) for identity, before, after in reversed(step)])
+
+    def redo(self):
+        if not self.redo_steps:
+            return 0
+        step = self.redo_steps.pop()
+        self.history.append(step)
+        return self.restore_step([(identity, after) for identity, before, after in step])
+
+    def restore_step(self, entries):
+        restored = 0
+        for identity, updated_data in entries:
+            record = self.get_record(identity)
+            if record:
+                record.set_updated_data(updated_data, track=False)
+                restored += 1
+        return restored
+
+    # Staged records in staging order, apart from those a background commit job is submitting (unless they
+    # were edited since). Kept up to date by Record, so this doesn't scan the zone
     def get_updated_records(self):
         updated_records = []
-        for record in self.original_records:
-            if record.updated_data:
-                updated_records.append(record)
+        for record in self.staged.values():
+            if self.in_flight and self.in_flight.get(record.identity) == record.updated_data:
+                continue
+            updated_records.append(record)
 
         return updated_records
 
+    # '<name>.jsonl' writes json lines, anything else a json array with one record per line
     def dump_changeset(self, filename):
+        filename, extension = os.path.splitext(filename)
+        if extension != ".jsonl":
+            filename, extension = filename + extension, ".json"
         updated_records = self.get_updated_records()
-        updated_record_list = [x.get_updated_record() for x in updated_records]
-        with open(f"changesets/{filename}.json", "w") as f:
-            f.write(json.dumps(updated_record_list, indent=4))
-
-        orig_record_list = [x.get_original_record() for x in updated_records]
-        with open(f"changesets/{filename}_orig.json", "w") as f:
-            f.write(json.dumps(orig_record_list, indent=4))
+        write_changeset(f"changesets/{filename}{extension}", (self.export_record(x) for x in updated_records))
+        write_changeset(f"changesets/{filename}_orig{extension}", (self.export_record(x, updated=False) for x in updated_records))
 
 
+    # Filters work on the positions in filtered_records, so no Records are made for them
+    @profiled("filter")
     def filter_records(self, field=None, filter_string=None):
         if field:
-            self.filtered_records = []
             if field == 'All':
                 self.filtered_records = self.original_records
+            elif field in FIELD_POLICIES:
+                self.filtered_records = RecordList(self, self.policy_index.get(FIELD_POLICIES[field], array("i")))
             else:
-                with display.status("Filtering {0} Records".format(field), spinner="dots"):
-                    for record in self.original_records:
-                        if record.__dict__.get(field, None):
-                            self.filtered_records.append(record)
+                with get_status("Filtering {0} Records".format(field)):
+                    self.filtered_records = RecordList(self, array("i", (i for i in range(len(self.store)) if self.store.get(i, field))))
         if filter_string:
             if filter_string.startswith(":"):
                 index_filter = int(filter_string.split(":")[1]) # select the index based on the special ':<int>' format
-                try:
-                    self.filtered_records = [self.filtered_records[index_filter]]
-                except IndexError:
-                    pass
+                if -len(self.filtered_records) <= index_filter < len(self.filtered_records):
+                    self.filtered_records = RecordList(self, array("i", [self.filtered_records.positions[index_filter]]))
             else:
-                filtered_list = []
-                for record in self.filtered_records:
-                    if filter_string in record.Name:
-                        filtered_list.append(record)
+                try:
+                    matches = set(self.name_search.search(filter_string))
+                except re.error:
+                    matches = set()
+                filtered_list = array("i", (i for i in self.filtered_records.positions if i in matches))
 
                 if not filtered_list: # If the resultant list is empty, dont return it. Instead return the last populated list
                     pass
                 else:
-                    self.filtered_records = filtered_list
-
-    def write_records(self):
-            changes = []
-            originals = []
-            to_update = []
-            updated_records = self.get_updated_records()
-            for record in updated_records:
-                change_record = {"Action":"UPSERT", "ResourceRecordSet": record.get_updated_record()}
-                to_update.append(change_record)
-                originals.append(record.get_original_record())
-                changes.append(record.get_updated_record())
-            try:
-                resp = self.client.change_resource_record_sets(HostedZoneId=HOSTED_ZONE_ID, ChangeBatch = {'Comment':'MTA Update','Changes': to_update})
-                status = resp['ResponseMetadata']['HTTPStatusCode']
-                if status == 200:
-                    logger.info("update: {0}\norig: {1}".format(changes, originals))
-                    for record in updated_records:
-                        record.reset()
-                    return "\n[green] Records Updated!"
-                    recordset.refresh_records()
-                    input("Press 'Enter' to continue...")
+                    self.filtered_records = RecordList(self, filtered_list)
+
+    # Records matching a routing policy, record type and name search, in zone order
+    @profiled("filter")
+    def select_records(self, policy=None, record_type=None, pattern=None):
+        positions = range(len(self.store))
+        if policy:
+            positions = self.policy_index.get(policy, array("i"))
+        if record_type:
+            type_positions = set(self.type_index.get(record_type, []))
+            positions = array("i", (i for i in positions if i in type_positions))
+        if pattern:
+            name_positions = set(self.name_search.search(pattern))
+            positions = array("i", (i for i in positions if i in name_positions))
+        return RecordList(self, positions)
+
+    def load_health_checks(self):
+        with get_status("Loading Health Checks"):
+            self.health_checks = {health_check["Id"]: health_check for health_check in list_health_checks(self.client)}
+
+    # Latency and failover records with a health check, optionally only those whose Region or SetIdentifier matches
+    def select_health_checked_records(self, pattern=None, region=None):
+        positions = (self.select_records("latency", pattern=pattern) + self.select_records("failover", pattern=pattern)).positions
+        positions = [i for i in positions if self.store.get(i, "HealthCheckId")]
+        if region:
+            positions = [i for i in positions if match_set_identifier(region, self.store.get(i, "Region", "")) or match_set_identifier(region, self.store.get(i, "SetIdentifier", ""))]
+        return RecordList(self, array("i", positions))
+
+    def get_health_check_records(self, health_check_id):
+        return RecordList(self, self.health_check_index.get(health_check_id, array("i")))
+
+    # Stage e.g. Inverted=True for the health checks of the records. Fields that already have that value are
+    # left out, so staging the current state drops a staged change. Returns the number of health checks staged
+    def stage_health_checks(self, records, **changes):
+        for health_check_id in {record.HealthCheckId for record in records if record.get("HealthCheckId")}:
+            config = self.health_checks.get(health_check_id, {}).get("HealthCheckConfig", {})
+            staged = dict(self.staged_health_checks.get(health_check_id, {}), **changes)
+            staged = {field: value for field, value in staged.items() if config.get(field, False) != value}
+            if staged:
+                self.staged_health_checks[health_check_id] = staged
+            else:
+                self.staged_health_checks.pop(health_check_id, None)
+        return len(self.staged_health_checks)
+
+    def apply_health_checks(self, progress=None):
+        results = update_health_checks(self.client, self.staged_health_checks, self.health_checks, progress=progress)
+        for result in results:
+            config = self.health_checks.get(result["health_check_id"], {}).get("HealthCheckConfig", {})
+            audit("health_check", health_check_id=result["health_check_id"], status=result["status"], error=result["error"], changes=result["changes"],
+                  original={field: config.get(field, False) for field in result["changes"]}, records=[record.Name for record in self.get_health_check_records(result["health_check_id"])])
+            if result["status"] == "FAILED":
+                continue
+            self.health_checks[result["health_check_id"]] = result["health_check"]
+            self.staged_health_checks.pop(result["health_check_id"], None)
+        return results
+
+    # Snapshot of the staged changes by zone, as (record, staged changes, record data to commit). Commits work
+    # from the snapshot, so records can be edited again while a commit is running
+    def get_staged_changes(self):
+        zone_staged = {}
+        for record in self.get_updated_records():
+            zone_staged.setdefault(record.zone_id, []).append((record, dict(record.updated_data), record.to_dict()))
+        return zone_staged
+
+    # Check a snapshot of the staged changes offline, so invalid changes fail before anything is submitted.
+    # Each staged record is checked once, then each weighted set with staged records in it is read from the
+    # name index (other members come from the store, not as dicts) for duplicate SetIdentifiers and TTLs that
+    # differ. Returns a {"record", "field", "error"} dict per problem, empty when the changes can be submitted
+    @profiled("validate")
+    def validate_staged(self, zone_staged=None):
+        zone_staged = self.get_staged_changes() if zone_staged is None else zone_staged
+        errors = []
+        desired = {} # position -> data to commit
+        sets = {} # (zone_id, Name, Type) -> staged records in the set
+        for zone_id, staged in zone_staged.items():
+            for record, updated_data, data in staged:
+                errors.extend({"record": record, "field": field, "error": error} for field, error in validate_record_data(data))
+                desired[record.position] = data
+                sets.setdefault((zone_id, data.get("Name"), data.get("Type")), []).append(record)
+
+        for (zone_id, name, record_type), records in sets.items():
+            members = {} # position -> (SetIdentifier, Weight, TTL) of every record in the set once committed
+            for position in self.get_name_positions(name) + [record.position for record in records]:
+                if self.store.zone_id(position) != zone_id: # the same set in another loaded zone is a different set
+                    continue
+                data = desired.get(position)
+                if data is not None:
+                    if (data.get("Name"), data.get("Type")) == (name, record_type):
+                        members[position] = (data.get("SetIdentifier"), data.get("Weight"), data.get("TTL"))
+                elif self.store.get(position, "Type") == record_type:
+                    members[position] = (self.store.get(position, "SetIdentifier"), self.store.get(position, "Weight"), self.store.get(position, "TTL"))
+            identifiers = Counter(member[0] for member in members.values() if member[0] is not None)
+            weighted = any(member[1] is not None for member in members.values())
+            # Staged TTLs have to match the records that aren't changing, or the most common one if the whole set is staged
+            ttls = {member[2] for position, member in members.items() if position not in desired and type(member[2]) is int}
+            if not ttls:
+                ttls = {ttl for ttl, count in Counter(member[2] for member in members.values() if type(member[2]) is int).most_common(1)}
+            for record in records:
+                set_identifier, weight, ttl = members[record.position]
+                if identifiers[set_identifier] > 1:
+                    errors.append({"record": record, "field": "SetIdentifier", "error": "{0} records in {1} {2} have the SetIdentifier {3}".format(
+                        identifiers[set_identifier], name, record_type, set_identifier)})
+                if weighted and type(ttl) is int and ttls - {ttl}:
+                    errors.append({"record": record, "field": "TTL", "error": "TTL {0} differs from the other records in the weighted set ({1})".format(
+                        ttl, ", ".join(str(other) for other in sorted(ttls - {ttl})))})
+        count_metric("validation_errors", len(errors))
+        return errors
+
+    # Submit a snapshot, each zone's batches in parallel. Only uses the client, so it can run in a background job
+    def submit_changes(self, zone_staged, wait=True, progress=None):
+        limiter = RateLimiter() # Route53's request rate limit is per account, so every zone shares it
+        commit_id = os.urandom(6).hex() # groups the commit's batches and changes in the audit log
+
+        def commit_zone(zone_id):
+            staged = zone_staged[zone_id]
+            changes = [{"Action":"UPSERT", "ResourceRecordSet": data} for record, updated_data, data in staged]
+
+            # Each batch and its changes are audited from here as soon as the batch is submitted, so an accepted
+            # batch is logged even if the commit never gets back to the main loop. Later states get a status line
+            def report(result):
+                batch = {"commit_id": commit_id, "zone_id": zone_id, "batch": result["batch"], "change_id": result["change_id"], "status": result["status"]}
+                if "commit_id" not in result:
+                    result["commit_id"] = commit_id
+                    result["records"] = [staged[i][0] for i in result["positions"]]
+                    result["staged"] = [staged[i][1] for i in result["positions"]]
+                    audit("batch", **batch, changes=len(result["changes"]), error=result["error"], submitted_at=result["submitted_at"], elapsed=result["elapsed"])
+                    for committed, change in zip(result["records"], result["changes"]):
+                        audit("change", **batch, action=change["Action"], record=change["ResourceRecordSet"], original=committed.to_dict(updated=False))
                 else:
-                    return "\n[red] Error updating records! \n {0}".format(resp)
-                    input("Press 'Enter' to continue...")
-                    
+                    audit("batch_status", **batch, error=result["error"], elapsed=result["elapsed"])
+                if progress:
+                    progress(result)
+
+            return commit_changes(self.client, zone_id, changes, wait=wait, progress=report, limiter=limiter)
+
+        with timed("commit"), ThreadPoolExecutor(max_workers=max(1, min(ZONE_WORKERS, len(zone_staged)))) as pool:
+            results = [result for zone_results in pool.map(commit_zone, list(zone_staged)) for result in zone_results]
+        count_metric("records_committed", sum(len(result["records"]) for result in results if result["status"] != "FAILED"))
+        count_metric("batches_failed", sum(1 for result in results if result["status"] == "FAILED"))
+        return results
+
+    # Make the committed changes part of the loaded records and the cache, so nothing needs refetching.
+    # Records are looked up again as a background refresh may have replaced them since the commit started,
+    # and records edited again since they were submitted stay staged. submit_changes has already written the
+    # batches to the audit log
+    def apply_commit_results(self, results):
+        for result in results:
+            if result["status"] == "FAILED":
+                continue
+            for committed, staged, change in zip(result["records"], result["staged"], result["changes"]):
+                record = self.get_record(committed.identity)
+                if not record:
+                    continue
+                self.replace_record_data(record, change["ResourceRecordSet"])
+                if record.updated_data == staged:
+                    record.set_updated_data({}, track=False) # committed, not an edit to undo
+                self.staged_bases.pop(record.identity, None)
+            self.last_change_ids[result["zone_id"]] = result["change_id"]
+
+        if self.cache:
+            for zone_id in {result["zone_id"] for result in results if result["status"] != "FAILED"}:
+                self.cache.save(zone_id, self.store.zone_records(zone_id), self.fetched_at, self.last_change_ids[zone_id])
+
+    # Commit every staged record and wait for it. Returns the batch results
+    def commit_staged_records(self, wait=True, progress=None):
+        results = self.submit_changes(self.get_staged_changes(), wait, progress)
+        self.apply_commit_results(results)
+        return results
+
+    # Commit the staged records in a background thread, leaving them out of the staged changes while it runs
+    def start_commit_job(self):
+        zone_staged = self.get_staged_changes()
+        for staged in zone_staged.values():
+            for record, updated_data, data in staged:
+                self.in_flight[record.identity] = updated_data
+        job = CommitJob(len(self.commit_jobs) + 1, self, zone_staged)
+        self.commit_jobs.append(job)
+        job.thread.start()
+        return job
+
+    # Called from the main loop, like apply_background_refresh, so records only change between screens
+    def apply_finished_jobs(self):
+        for job in self.commit_jobs:
+            if job.applied or job.is_running():
+                continue
+            self.apply_commit_results(job.results)
+            for staged in job.zone_staged.values():
+                for record, updated_data, data in staged:
+                    self.in_flight.pop(record.identity, None)
+            job.applied = True
+
+    def running_jobs(self):
+        return [job for job in self.commit_jobs if job.is_running()]
+
+    def write_records(self, wait=True):
+            noops = self.drop_noop_changes()
+            skipped = "\n[yellow]Skipped {0} staged records that already match AWS".format(len(noops)) if noops else ""
+            if not self.get_updated_records():
+                return skipped + "\n[yellow]No changes to apply"
+            errors = self.validate_staged()
+            if errors:
+                return skipped + get_validation_report(errors)
+            try:
+                with get_status("Submitting {0} changes".format(len(self.get_updated_records()))) as status:
+                    done = []
+                    def progress(result):
+                        done.append(result)
+                        status.update("{0} batch {1}: {2} ({3} updates reported)".format(result["zone_id"], result["batch"] + 1, result["status"], len(done)))
+                    results = self.commit_staged_records(wait=wait, progress=progress)
             except Exception as e:
                 return "\n[red]Error updating records: \n {0}".format(e)
-                input("Press 'Enter' to continue...")
+
+            messages = []
+            for result in results:
+                if result["status"] == "FAILED":
+                    messages.append("[red]{0} batch {1}: {2} changes failed\n {3}".format(result["zone_id"], result["batch"] + 1, len(result["records"]), result["error"]))
+                else:
+                    messages.append("[green]{0} batch {1}: {2} changes {3} ({4})".format(result["zone_id"], result["batch"] + 1, len(result["records"]), result["status"], result["change_id"]))
+            if all(result["status"] != "FAILED" for result in results):
+                messages.insert(0, "[green] Records Updated!")
+            return skipped + "\n" + "\n".join(messages)
+
+
+# A commit running in a background thread. Batch results fill in as they are submitted and reach INSYNC
+class CommitJob:
+    def __init__(self, job_id, recordset, zone_staged):
+        self.job_id = job_id
+        self.zone_staged = zone_staged
+        self.records = sum(len(staged) for staged in zone_staged.values())
+        self.batches = {} # (zone_id, batch) -> result, as reported so far
+        self.batches_lock = threading.Lock() # batches is filled in by the commit's threads and read by the menu
+        self.results = []
+        self.error = None
+        self.applied = False
+        self.started_at = time.time()
+        self.finished_at = None
+        self.thread = threading.Thread(target=self.run, args=(recordset,), daemon=True)
+
+    def run(self, recordset):
+        try:
+            self.results = recordset.submit_changes(self.zone_staged, wait=True, progress=self.progress)
+        except Exception as e:
+            self.error = e
+        self.finished_at = time.time()
+
+    def progress(self, result):
+        with self.batches_lock:
+            self.batches[(result["zone_id"], result["batch"])] = result
+
+    # The batches reported so far, in zone and batch order
+    def get_batches(self):
+        with self.batches_lock:
+            batches = list(self.batches.items())
+        return [result for key, result in sorted(batches)]
+
+    def is_running(self):
+        return self.thread.is_alive()
+
+    def get_status(self):
+        if self.is_running():
+            return "RUNNING"
+        if self.error or any(result["status"] in ("FAILED", "TIMEOUT") for result in self.results):
+            return "FAILED"
+        return "DONE"
+
+
+# Round weights to integers in 0-MAX_WEIGHT that add up to `total`, giving the leftover units to the
+# largest fractions. Only values that were rounded down get a unit, so whole values are never changed.
+# The total can only be missed when clamping makes it unreachable
+def round_weights(values, total):
+    values = [min(max(value, 0), MAX_WEIGHT) for value in values]
+    total = min(max(total, 0), MAX_WEIGHT * len(values))
+    weights = [int(value) for value in values]
+    extra = int(round(total)) - sum(weights)
+    for i in sorted((i for i in range(len(values)) if values[i] > weights[i]), key=lambda i: weights[i] - values[i]):
+        if extra <= 0:
+            break
+        weights[i] += 1
+        extra -= 1
+    return weights
+
+
+# SetIdentifier patterns use the same syntax as name filters, apart from regexes
+def match_set_identifier(pattern, set_identifier):
+    if any(char in pattern for char in "*?["):
+        return fnmatch.fnmatchcase(set_identifier, pattern)
+    return pattern in set_identifier
+
+
+# Bulk weight operations over many weighted record sets. The selected records' (staged) weights are copied into
+# one flat list ordered by record set (zone, Name, Type), each operation works on every set's slice of the
+# list, and apply() stages only the weights that changed
+class WeightEngine:
+    def __init__(self, records):
+        groups = {}
+        for record in records:
+            if record.get("Weight") is not None:
+                groups.setdefault((record.zone_id, record.Name, record.Type), []).append(record)
+        self.records = [record for members in groups.values() for record in members]
+        self.weights = [record.get_updated_record()["Weight"] for record in self.records]
+        self.set_identifiers = [record.get("SetIdentifier", "") for record in self.records]
+        self.bounds = [] # (start, end) of each record set in the flat lists
+        for members in groups.values():
+            start = self.bounds[-1][1] if self.bounds else 0
+            self.bounds.append((start, start + len(members)))
+
+    def set(self, weight):
+        self.weights = [weight] * len(self.weights)
+
+    # Multiply every weight by factor, the set's total is scaled by the same factor
+    def scale(self, factor):
+        for start, end in self.bounds:
+            group = self.weights[start:end]
+            self.weights[start:end] = round_weights([weight * factor for weight in group], sum(group) * factor)
+
+    # Spread `total` over each set in proportion to the current weights, or evenly if they are all 0
+    def normalize(self, total=MAX_WEIGHT):
+        for start, end in self.bounds:
+            group = self.weights[start:end]
+            current = sum(group)
+            targets = [weight * total / current for weight in group] if current else [total / len(group)] * len(group)
+            self.weights[start:end] = round_weights(targets, total)
+
+    # Move percent of the weight of the records whose SetIdentifier matches source to the ones matching
+    # target, in proportion to their current weights. At most what the targets can take below MAX_WEIGHT is
+    # moved, the sources keep the rest, so each set keeps its total and no other record changes
+    def shift(self, percent, source, target):
+        for start, end in self.bounds:
+            group = self.weights[start:end]
+            sources = [i for i in range(end - start) if match_set_identifier(source, self.set_identifiers[start + i])]
+            targets = [i for i in range(end - start) if i not in sources and match_set_identifier(target, self.set_identifiers[start + i])]
+            source_total = sum(group[i] for i in sources)
+            if not targets or not source_total:
+                continue
+            moved = min(source_total * percent / 100, sum(MAX_WEIGHT - group[i] for i in targets))
+            values = [float(weight) for weight in group]
+            for i in sources:
+                values[i] -= moved * group[i] / source_total
+            # Targets that reach MAX_WEIGHT pass what they can't take on to the others
+            left, open_targets = moved, targets
+            while left > 1e-9 and open_targets:
+                target_total = sum(group[i] for i in open_targets)
+                for i in open_targets:
+                    values[i] += left * (group[i] / target_total if target_total else 1 / len(open_targets))
+                left = sum(max(values[i] - MAX_WEIGHT, 0) for i in open_targets)
+                for i in open_targets:
+                    values[i] = min(values[i], MAX_WEIGHT)
+                open_targets = [i for i in open_targets if values[i] < MAX_WEIGHT]
+            weights = round_weights(values, sum(group))
+            if any(weights[i] != group[i] for i in range(end - start) if i not in sources and i not in targets):
+                continue # never change records outside the source and target, the set is left as it was
+            self.weights[start:end] = weights
+
+    def apply(self):
+        changed = []
+        for record, weight in zip(self.records, self.weights):
+            if weight != record.get_updated_record()["Weight"]:
+                record.update("Weight", weight)
+                changed.append(record)
+        return changed
+
+
+# Scale factors, normalize totals and shift percentages for the menu and the reweight command, ValueError
+# if out of range
+def parse_scale(text):
+    factor = float(text)
+    if not math.isfinite(factor) or factor < 0:
+        raise ValueError("scale factor must be a finite number of 0 or more")
+    return factor
+
+
+def parse_total(text):
+    total = int(text)
+    if total < 0:
+        raise ValueError("total must be 0 or more")
+    return total
+
+
+def parse_percent(text):
+    try:
+        percent = float(text.rstrip("%"))
+    except ValueError:
+        percent = math.nan
+    if not 0 <= percent <= 100: # also false for nan
+        raise ValueError("percent must be between 0-100")
+    return percent
+
+
+# Menu syntax for weight operations: '<weight>', 'x<factor>', 'norm [total]' or 'shift <percent> <from> <to>'.
+# Returns the WeightEngine method name and its arguments, None if the input isn't valid
+def parse_weight_operation(text):
+    words = text.split()
+    try:
+        if len(words) == 1 and words[0].isdigit() and int(words[0]) <= MAX_WEIGHT:
+            return "set", [int(words[0])]
+        if len(words) == 1 and words[0].startswith("x"):
+            return "scale", [parse_scale(words[0][1:])]
+        if words and words[0] == "norm" and len(words) <= 2:
+            return "normalize", [parse_total(words[1]) if len(words) == 2 else MAX_WEIGHT]
+        if len(words) == 4 and words[0] == "shift":
+            return "shift", [parse_percent(words[1]), words[2], words[3]]
+    except ValueError:
+        pass
+    return None
+
+
+# Keeps the weighted and latency record sets shown in the live view up to date. Each tick polls as many sets
+# as the rate allows, least recently polled first, and only the rows of sets whose records changed are rebuilt
+class TrafficMonitor:
+    def __init__(self, recordset, records, max_rows=None, rate=LIVE_RATE, tick=LIVE_TICK):
+        self.recordset = recordset
+        self.tick = tick
+        self.limiter = RateLimiter(rate)
+        self.sets = {} # (zone_id, Name, Type) -> {record_key: data}
+        for record in records:
+            data = record.original_data
+            self.sets.setdefault((record.zone_id, record.Name, record.Type), {})[record_key(data)] = data
+        self.total_sets = len(self.sets)
+        if max_rows: # only the sets that fit on screen are shown, and polled
+            rows = 0
+            for set_key in list(self.sets):
+                rows += len(self.sets[set_key])
+                if rows > max_rows and len(self.sets) > 1:
+                    del self.sets[set_key]
+        self.polls_per_tick = max(1, int(rate * tick)) if rate > 0 else len(self.sets)
+        self.queue = deque(self.sets)
+        self.rows = {} # set key -> rendered rows, dropped when the set changes
+        self.changed_at = {} # set key -> when a change was last seen
+        self.polled_at = None
+        self.last_error = None
+
+    def fetch_set(self, set_key):
+        return fetch_record_set(self.recordset.client, *set_key, limiter=self.limiter)
+
+    # Poll the next sets in turn, returning the keys of the sets that changed. API and network errors
+    # (connection failures, read timeouts) are shown in the caption and retried on the next tick
+    def poll(self):
+        from botocore.exceptions import BotoCoreError
+        changed = []
+        for _ in range(min(self.polls_per_tick, len(self.queue))):
+            set_key = self.queue[0]
+            self.queue.rotate(-1)
+            try:
+                members = self.fetch_set(set_key)
+            except Exception as e:
+                if not get_error_code(e) and not isinstance(e, BotoCoreError):
+                    raise
+                self.last_error = e
+                break
+            if members != self.sets[set_key]:
+                self.sets[set_key] = members
+                self.rows.pop(set_key, None)
+                self.changed_at[set_key] = time.time()
+                changed.append(set_key)
+        self.polled_at = time.time()
+        return changed
+
+    # Weighted records get a bar with their share of the set's total weight, latency records their region
+    def render_set(self, set_key):
+        members = sorted(self.sets[set_key].values(), key=lambda data: data.get("SetIdentifier", ""))
+        total = sum(data.get("Weight", 0) for data in members)
+        rows = []
+        for data in members:
+            if "Weight" in data:
+                share = data["Weight"] / total if total else 0
+                bar = "[green]" + "\u2588" * round(share * LIVE_BAR_WIDTH) + "[/green]" + "\u2591" * (LIVE_BAR_WIDTH - round(share * LIVE_BAR_WIDTH))
+                routing = "{0} {1:>3} {2:6.1%}".format(bar, data["Weight"], share)
+            else:
+                routing = data.get("Region", "")
+            values = ", ".join(value["Value"] for value in data.get("ResourceRecords", [])) or data.get("AliasTarget", {}).get("DNSName", "")
+            rows.append([data.get("SetIdentifier", ""), routing, values])
+        if rows:
+            rows[0] = [set_key[1], set_key[2]] + rows[0]
+            rows[1:] = [["", ""] + row for row in rows[1:]]
+        return rows or [[set_key[1], set_key[2], "", "[red]no records", ""]]
+
+    def create_table(self):
+        from rich.table import Table
+
+        table = Table(title="Live Traffic", caption=self.get_caption())
+        for header in ("Name", "Type", "SetIdentifier", "Weight Share / Region", "Values"):
+            table.add_column(header)
+        recent = time.time() - 3 * self.tick
+        for set_key in self.sets:
+            if set_key not in self.rows:
+                self.rows[set_key] = self.render_set(set_key)
+            style = "bold yellow" if self.changed_at.get(set_key, 0) > recent else ""
+            for row in self.rows[set_key]:
+                table.add_row(*row, style=style)
+        return table
+
+    def get_caption(self):
+        caption = "{0} of {1} sets, {2} polled every {3:g}s".format(len(self.sets), self.total_sets, min(self.polls_per_tick, len(self.sets)), self.tick)
+        if self.polled_at:
+            caption += ", last poll {0}".format(time.strftime("%H:%M:%S", time.localtime(self.polled_at)))
+        if self.last_error:
+            caption += " [red](last error: {0})".format(self.last_error)
+        return caption + " - Ctrl-C to return to the menu"
+
+
+# Names without a directory are looked up in changesets/, '-' reads from stdin
+def get_changeset_path(filename):
+    if filename == "-" or os.path.dirname(filename):
+        return filename
+    return os.path.join("changesets", filename)
 
 
 def load_changeset_from_file(recordset):
+    from rich import print as rprint
+    from rich.prompt import Prompt
+    from rich.table import Table
+
     changeset_file_list = os.listdir('changesets')
 
     table = Table(title="Changeset Files")
@@ -294,7 +2023,10 @@ def load_changeset_from_file(recordset):
                 else:
                     selected_file = changeset_file_list[int(file_choice)]
                     display.end_screen()
-                    load_records(recordset, selected_file)
+                    results = load_records(recordset, selected_file)
+                    display.update_screen(get_load_report(results))
+                    input("Press 'Enter' to continue...")
+                    display.end_screen()
                     break
             except ValueError:
                     display.end_screen()
@@ -309,28 +2041,132 @@ def load_changeset_from_file(recordset):
     display.end_screen()
 
 
+# Return the record a change should be applied to, or the list of candidates if it is ambiguous
 def match_original_record(recordset, change_record):
-    for record in recordset.original_records:
-        if change_record["Name"] == record.Name and change_record["ResourceRecords"] == record.ResourceRecords and change_record["Type"] == record.Type:
-            record.updated_data = change_record
+    matches = recordset.find_records(change_record)
+    if len(matches) == 1:
+        matches[0].set_updated_data({k: v for k, v in change_record.items() if k != "HostedZoneId"})
+    return matches
 
 
+# Changesets are either json lines or a json array, which is parsed one element at a time
+def iter_changeset(path, chunk_size=65536):
+    if path == "-":
+        yield from iter_changeset_file(sys.stdin, chunk_size)
+    else:
+        with open(path, 'r') as f:
+            yield from iter_changeset_file(f, chunk_size)
+
+
+def iter_changeset_file(f, chunk_size=65536):
+    start = f.read(chunk_size)
+    if start.lstrip().startswith("["):
+        yield from iter_json_array(f, chunk_size, start)
+    else:
+        start += f.readline() # finish the line the first chunk ended in
+        for line in itertools.chain(io.StringIO(start), f):
+            if line.strip():
+                yield json.loads(line)
+
+
+def iter_json_array(f, chunk_size=65536, buffer=""):
+    decoder = json.JSONDecoder()
+    position = 0
+    eof = False
+    started = False
+    while True:
+        while position < len(buffer) and buffer[position] in " \t\r\n,":
+            position += 1
+        if position == len(buffer) and not eof:
+            chunk = f.read(chunk_size)
+            buffer, position, eof = buffer[position:] + chunk, 0, not chunk
+            continue
+        if position == len(buffer):
+            if started:
+                raise ValueError("Changeset array is not terminated")
+            return
+        if not started:
+            if buffer[position] != "[":
+                raise ValueError("Changeset must be a json array or json lines (.jsonl) file")
+            started = True
+            position += 1
+            continue
+        if buffer[position] == "]":
+            return
+        try:
+            item, position = decoder.raw_decode(buffer, position)
+        except json.JSONDecodeError:
+            if eof:
+                raise
+            chunk = f.read(chunk_size) # the element continues in the next chunk
+            buffer, position, eof = buffer[position:] + chunk, 0, not chunk
+            continue
+        yield item
+
+
+def write_changeset(path, records):
+    with open(path, "w") as f:
+        if path.endswith(".jsonl"):
+            for record in records:
+                f.write(json.dumps(record) + "\n")
+        else:
+            separator = "[\n"
+            for record in records:
+                f.write(separator + json.dumps(record))
+                separator = ",\n"
+            f.write("[]\n" if separator == "[\n" else "\n]\n")
+
+
+@profiled("load_changeset")
 def load_records(recordset, filename):
-    with open("changesets/{0}".format(filename), 'r') as f:
-        data = json.loads(f.read())
+    return stage_change_records(recordset, iter_changeset(get_changeset_path(filename)))
+
+
+def stage_change_records(recordset, change_records):
+    results = {"matched": [], "unmatched": [], "ambiguous": []}
+    with recordset.edit_group(): # undone as a whole
+        for change_record in change_records:
+            matches = match_original_record(recordset, change_record)
+            if len(matches) == 1:
+                results["matched"].append(change_record)
+            elif not matches:
+                results["unmatched"].append(change_record)
+            else: # never guess which of several records a change was meant for
+                results["ambiguous"].append(change_record)
+
+    return results
 
-    for change_record in data:
-        match_original_record(recordset, change_record)
+
+def get_load_report(results):
+    report = "\n[green]Matched: {0}[/green]  [yellow]Unmatched: {1}[/yellow]  [red]Ambiguous: {2}[/red]".format(
+        len(results["matched"]), len(results["unmatched"]), len(results["ambiguous"]))
+    for label, color in (("unmatched", "yellow"), ("ambiguous", "red")):
+        for change_record in results[label]:
+            report += "\n[{0}]{1}: {2} {3} {4}[/{0}]".format(color, label, change_record.get("Name"), change_record.get("Type"), change_record.get("SetIdentifier", ""))
+    return report
+
+
+def get_validation_report(errors, limit=20):
+    report = "\n[red]{0} problems in {1} staged records, nothing was submitted".format(len(errors), len({error["record"].identity for error in errors}))
+    for error in errors[:limit]:
+        record = error["record"]
+        report += "\n[red]{0} {1} {2}[/red] {3}: {4}".format(record.Name, record.Type, record.get("SetIdentifier", ""), error["field"], error["error"])
+    if len(errors) > limit:
+        report += "\n[red]... and {0} more".format(len(errors) - limit)
+    return report
 
 
 def edit_weight_records_by_filter(recordset):
+    from rich import print as rprint
+    from rich.console import RenderGroup
+    from rich.prompt import Confirm, Prompt
 
     original_filtered_set = recordset.filtered_records # this is our fallback
     weighted_record_table = display.create_table(recordset.filtered_records, "weighted")
 
     display.update_screen(weighted_record_table)
     while True:
-        search_filter = Prompt.ask("Filter ('..' to reset filter, 'Enter' to use current selection, ':<index>' for record #, ':q' to exit)")
+        search_filter = Prompt.ask("Filter ('..' to reset filter, 'Enter' to use current selection, ':<index>' for record #, '~<regex>' or a * glob to match names, ':q' to exit)")
         if search_filter == "..": # if user enters '..' return full list of weighted records again 
             recordset.filtered_records = original_filtered_set
             weighted_record_table = display.create_table(recordset.filtered_records, "weighted")
@@ -341,20 +2177,20 @@ def edit_weight_records_by_filter(recordset):
         elif search_filter == "": # The user has filtered choice to records shown on screen and presses enter with no other chars
             selection_table = display.create_table(recordset.filtered_records, "weighted", bgcolors=[136, 132])
 
-            valid_weight = False # wait for valid weight value for records to be entered 
+            operation = None # wait for a valid weight or weight operation to be entered
             error = 0
-            while not valid_weight:
+            while not operation:
                 display.update_screen(selection_table)
                 if error:
-                    rprint("[yellow]Enter a valid record weight between 0-255")
-                weight_setting = IntPrompt.ask("Enter weight to set selected records to (0-255)")
-                if weight_setting in range(0,256):
-                    valid_weight = True
-                else:
-                    error = 1
+                    rprint("[yellow]Enter a weight between 0-255, 'x<factor>', 'norm [total]' or 'shift <percent> <from> <to>'")
+                operation = parse_weight_operation(Prompt.ask("Enter weight to set selected records to (0-255), 'x<factor>' to scale, 'norm [total]' to make each set add up to 255 (or total), 'shift <percent> <from> <to>' to move weight between SetIdentifiers"))
+                error = 1
 
-            for record in recordset.filtered_records:
-                record.update("Weight", weight_setting)
+            method, operation_args = operation
+            engine = WeightEngine(recordset.filtered_records)
+            getattr(engine, method)(*operation_args)
+            with recordset.edit_group():
+                changed = engine.apply()
 
             update_table = display.create_table(recordset.filtered_records, 'weighted', updated_records=True, bgcolors=[66, 62]) # Create update table with new weights shown
 
@@ -366,8 +2202,8 @@ def edit_weight_records_by_filter(recordset):
                 display.end_screen()
                 break
             else:
-                for record in recordset.filtered_records:
-                    record.reset()
+                if changed:
+                    recordset.undo()
                 rprint("Update Cancelled")
                 time.sleep(2)
                 display.end_screen()
@@ -381,12 +2217,9 @@ def edit_weight_records_by_filter(recordset):
 
 
 def get_staged_changes_view(recordset):
-    updated_records = recordset.get_updated_records()
-    if updated_records:
-        orig_table = display.create_table(updated_records, "weighted", bgcolors=[160,160])
-        update_table = display.create_table(updated_records, "weighted", updated_records=True, bgcolors=[70,70])
-
-        display.split_display(orig_table, update_table)
+    diff = recordset.diff_staged()
+    if diff:
+        display.update_screen(display.create_diff_table(diff))
         input("Press 'Enter' to continue...")
         display.end_screen()
 
@@ -397,6 +2230,8 @@ def get_staged_changes_view(recordset):
 
 
 def edit_staged_changes(recordset):
+    from rich import print as rprint
+    from rich.prompt import Prompt
     updated_records = recordset.get_updated_records()
     if updated_records:
         orig_table = display.create_table(updated_records, "weighted", bgcolors=[160,160])
@@ -408,8 +2243,15 @@ def edit_staged_changes(recordset):
                 input("Press 'Enter' to continue...")
                 break
             else:
-                delete_choice = Prompt.ask("Select an index to delete from staged changes. 'q' to exit")
-            if delete_choice != "q":
+                delete_choice = Prompt.ask("Select an index to delete from staged changes. 'u' to undo the last edit, 'q' to exit")
+            if delete_choice == "u":
+                recordset.undo()
+                updated_records = recordset.get_updated_records()
+                orig_table = display.create_table(updated_records, "weighted", bgcolors=[160,160])
+                update_table = display.create_table(updated_records, "weighted", updated_records=True, bgcolors=[70,70])
+                display.end_screen()
+                display.split_display(orig_table, update_table)
+            elif delete_choice != "q":
                 try:
                     delete_choice = int(delete_choice)
                     if delete_choice not in range(0, len(updated_records)):
@@ -440,16 +2282,27 @@ def edit_staged_changes(recordset):
 
 # Update AWS records to match locally cached record changes
 def update_records(recordset):
-    updated_records = recordset.get_updated_records()
-    if updated_records:
-        orig_table = display.create_table(updated_records, "weighted", bgcolors=[160,160])
-        update_table = display.create_table(updated_records, "weighted", updated_records=True, bgcolors=[70,70])
-    
-        display.split_display(orig_table, update_table)
-        if Confirm.ask("[green]Are you sure you want to apply these changes?"):
-            resp = recordset.write_records()
-            display.update_screen(resp)
-            input("Press 'Enter' to continue...")
+    from rich.prompt import Confirm
+    diff = recordset.diff_staged()
+    errors = recordset.validate_staged() if diff else []
+    if errors:
+        display.update_screen(get_validation_report(errors) + "\n[yellow]Fix or reset these records with option 8 (Edit Staged Changes)")
+        input("Press 'Enter' to continue...")
+        display.end_screen()
+    elif diff:
+        display.update_screen(display.create_diff_table(diff))
+        if any(entry["drift"] for entry in diff):
+            prompt = "[red]Some records changed in AWS since they were staged. Apply these changes anyway?"
+        else:
+            prompt = "[green]Are you sure you want to apply these changes?"
+        if Confirm.ask(prompt):
+            recordset.drop_noop_changes()
+            if recordset.get_updated_records():
+                job = recordset.start_commit_job()
+                display.update_screen("\n[green]Commit job {0} started for {1} records, follow it with option 11 (Commit Jobs)".format(job.job_id, job.records))
+            else:
+                display.update_screen("\n[yellow]All staged records already match AWS, nothing to commit")
+            time.sleep(2)
             display.end_screen()
         else:
             display.update_screen("\n[yellow]Cancelling Apply")
@@ -461,10 +2314,99 @@ def update_records(recordset):
         display.end_screen()
 
 
+def get_commit_jobs_table(recordset):
+    from rich.table import Table
+
+    table = Table(title="Commit Jobs", caption="Changes are applied to the loaded records and the cache once a job is done")
+    for header in ("Job", "Zone", "Batch", "Changes", "Change Id", "Status", "Seconds"):
+        table.add_column(header)
+    colors = {"INSYNC": "green", "PENDING": "yellow", "QUEUED": "yellow", "FAILED": "red", "TIMEOUT": "red"}
+    for job in reversed(recordset.commit_jobs):
+        results = job.results or job.get_batches()
+        if job.error:
+            table.add_row(str(job.job_id), "", "", str(job.records), "", "[red]ERROR: {0}".format(job.error), "")
+        elif not results:
+            table.add_row(str(job.job_id), "", "", str(job.records), "", "[yellow]SUBMITTING", "{0:.0f}".format(time.time() - job.started_at))
+        for result in results:
+            elapsed = "{0:.0f}".format(result["elapsed"]) if result["elapsed"] is not None else ""
+            status = "[{0}]{1}".format(colors.get(result["status"], "white"), result["status"])
+            table.add_row(str(job.job_id), result["zone_id"], str(result["batch"] + 1), str(len(result["changes"])), result["change_id"] or "", status, elapsed)
+    return table
+
+
+def get_commit_jobs_view(recordset):
+    from rich.prompt import Prompt
+    if not recordset.commit_jobs:
+        display.update_screen("\n[yellow]No commit jobs yet")
+        time.sleep(2)
+        display.end_screen()
+        return
+    while True:
+        recordset.apply_finished_jobs()
+        display.update_screen(get_commit_jobs_table(recordset))
+        if Prompt.ask("'Enter' to refresh, 'q' to return to the menu", default="", show_default=False).strip() == "q":
+            break
+    display.end_screen()
+
+
+HEALTH_CHECK_ACTIONS = {"i": {"Inverted": True}, "u": {"Inverted": False}, "d": {"Disabled": True}, "e": {"Disabled": False}}
+
+
+def edit_health_checks(recordset):
+    from rich import print as rprint
+    from rich.prompt import Confirm, Prompt
+
+    if not recordset.health_checks:
+        recordset.load_health_checks()
+    recordset.filtered_records = recordset.select_health_checked_records() # latency and failover records with a health check
+    original_filtered_set = recordset.filtered_records
+    message = ""
+    while True:
+        display.update_screen(display.create_health_check_table(recordset, recordset.filtered_records))
+        if message:
+            rprint(message)
+            message = ""
+        choice = Prompt.ask("Filter ('..' to reset, name filter or 'r <region>'), 'i' invert, 'u' uninvert, 'd' disable, 'e' enable the listed health checks, 'a' apply staged, 'c' clear staged, ':q' to exit")
+        if choice == ":q":
+            break
+        elif choice == "..":
+            recordset.filtered_records = original_filtered_set
+        elif choice in HEALTH_CHECK_ACTIONS:
+            staged = recordset.stage_health_checks(recordset.filtered_records, **HEALTH_CHECK_ACTIONS[choice])
+            message = "[green]{0} health check updates staged".format(staged)
+        elif choice == "c":
+            recordset.staged_health_checks = {}
+        elif choice == "a":
+            total = len(recordset.staged_health_checks)
+            if not total:
+                message = "[yellow]No health check updates staged"
+            elif Confirm.ask("[green]Update {0} health checks?".format(total)):
+                started = time.time()
+                with get_status("Updating Health Checks") as status:
+                    done = []
+                    def progress(result):
+                        done.append(result)
+                        status.update("{0}/{1} health checks updated".format(len(done), total))
+                    results = recordset.apply_health_checks(progress)
+                failed = [result for result in results if result["status"] == "FAILED"]
+                message = "[green]Updated {0} health checks in {1:.1f}s".format(len(results) - len(failed), time.time() - started)
+                message += "".join("\n[red]{0}: {1}".format(result["health_check_id"], result["error"]) for result in failed)
+        elif choice.startswith("r "):
+            region = choice[2:].strip()
+            matched = set(recordset.select_health_checked_records(region=region).positions)
+            filtered_list = array("i", (i for i in recordset.filtered_records.positions if i in matched))
+            if filtered_list: # like name filters, an empty result keeps the current list
+                recordset.filtered_records = RecordList(recordset, filtered_list)
+        else:
+            recordset.filter_records(filter_string=choice)
+    display.end_screen()
+
+
 def dump_changesets(recordset):
+    from rich.prompt import Prompt
     updated_records = recordset.get_updated_records()
     if updated_records:
-        changeset_filename = Prompt.ask("\n[blue]Enter a filename to write changesets to (will create new and original records in two files)")
+        changeset_filename = Prompt.ask("\n[blue]Enter a filename to write changesets to (will create new and original records in two files, end with .jsonl for json lines)")
         recordset.dump_changeset(changeset_filename)
     else:
         display.update_screen("\n[yellow]No records staged. Stage some changes and then try again")
@@ -474,8 +2416,10 @@ def dump_changesets(recordset):
 
 
 # Create main menu table
-def get_menu_table():
-    table = Table(title="Main Menu")
+def get_menu_table(recordset):
+    from rich.table import Table
+
+    table = Table(title="Main Menu", caption=get_cache_status(recordset))
     table.add_column("Selection")
     table.add_column("Option Name")
 
@@ -484,27 +2428,90 @@ def get_menu_table():
     table.add_row("3",  "List All Latency Records")
     table.add_row("4",  "Update Weighted Records")
     table.add_row("5",  "Load Changeset From File")
+    table.add_row("6",  "Live Traffic View")
     table.add_row("7",  "View Staged Changes")
     table.add_row("8",  "Edit Staged Changes")
     table.add_row("9",  "Commit Changes")
     table.add_row("10",  "Dump Changesets")
+    table.add_row("11",  "Commit Jobs")
+    table.add_row("12",  "Undo Staged Edit ({0})".format(len(recordset.history)))
+    table.add_row("13",  "Redo Staged Edit ({0})".format(len(recordset.redo_steps)))
+    table.add_row("14",  "Invert/Disable Latency Health Checks")
     table.add_row("99", "Refresh Record Cache")
     table.add_row("0",  "Quit")
 
     return table
 
 
+def get_cache_status(recordset):
+    if not recordset.is_loaded():
+        return "Loading records from AWS..."
+    status = "{0} records in {1} zone(s), fetched {2}s ago".format(len(recordset.original_records), len(recordset.zone_ids), int(recordset.cache_age()))
+    if recordset.is_refreshing():
+        status += " (refreshing in background)"
+    elif recordset.background_error:
+        status += " (background refresh failed: {0})".format(recordset.background_error)
+    running = recordset.running_jobs()
+    if running:
+        status += "\n{0} commit job(s) running, see option 11".format(len(running))
+    stats = get_api_stats()
+    if stats["throttled"] or stats["retries"] or stats["backoff_retries"]:
+        status += "\nAPI: {0} calls, {1} throttled, {2} retried by botocore, {3} backed off".format(stats["calls"], stats["throttled"], stats["retries"], stats["backoff_retries"])
+    return status
+
+
+def undo_redo(recordset, redo=False):
+    changed = recordset.redo() if redo else recordset.undo()
+    if changed:
+        display.update_screen("\n[green]{0} the staged changes of {1} records, {2} records now staged".format("Redid" if redo else "Undid", changed, len(recordset.get_updated_records())))
+    else:
+        display.update_screen("\n[yellow]Nothing to {0}".format("redo" if redo else "undo"))
+    time.sleep(2)
+    display.end_screen()
+
+
 def refresh_record_cache(recordset):
-    recordset.refresh_records(init=False)
+    recordset.refresh_records()
     display.clear()
     display.update_screen("[green]Records refreshed from AWS")
     time.sleep(2)
     display.end_screen()
 
 
+def live_traffic_view(recordset):
+    from rich.live import Live
+    from rich.prompt import Prompt
+    pattern = Prompt.ask("\n[blue]Filter record names for the live view (blank for every weighted and latency record)", default="", show_default=False).strip()
+    try:
+        records = recordset.select_records("weighted", pattern=pattern) + recordset.select_records("latency", pattern=pattern)
+    except re.error:
+        records = []
+    if not records:
+        display.update_screen("\n[yellow]No weighted or latency records match")
+        time.sleep(2)
+        display.end_screen()
+        return
+
+    monitor = TrafficMonitor(recordset, records, max_rows=display.get_page_size())
+    display.clear()
+    try:
+        with Live(monitor.create_table(), console=display.console, auto_refresh=False) as live:
+            while True:
+                started = time.monotonic()
+                monitor.poll()
+                live.update(monitor.create_table(), refresh=True)
+                time.sleep(max(0, monitor.tick - (time.monotonic() - started)))
+    except KeyboardInterrupt:
+        pass
+
+
 def confirm_quit(recordset):
+    from rich.prompt import Confirm
     updated_records = recordset.get_updated_records()
-    if len(updated_records) > 0:
+    if recordset.running_jobs():
+        if Confirm.ask("[yellow]Commit jobs are still running, batches that were not submitted yet will be lost... Are you sure you want to quit?"):
+            sys.exit(0)
+    elif len(updated_records) > 0:
         if Confirm.ask("[yellow]There are staged changes pending... Are you sure you want to quit before applying changes?"):
             sys.exit(0)
     else:
@@ -512,21 +2519,416 @@ def confirm_quit(recordset):
 
 
 def unattended_apply(recordset, filename):
-    load_records(recordset, filename)
-    recordset.write_records()
+    from rich import print as rprint
+    results = load_records(recordset, filename)
+    rprint(get_load_report(results))
+    rprint(recordset.write_records())
     sys.exit(0)
 
 
 
-def main():
-    recordset = RecordSet()
+# Batch commands: machine readable output, no rich display or prompts
+OUTPUT_FIELDS=["HostedZoneId", "Name", "Type", "SetIdentifier", "Weight", "Region", "Failover", "TTL", "Values", "AliasTarget", "HealthCheckId"]
+POLICIES=["weighted", "latency", "failover", "geo", "multivalue", "simple"]
+VALIDATION_FIELDS=["HostedZoneId", "Name", "Type", "SetIdentifier", "field", "error"]
+AUDIT_COMMIT_FIELDS=["time", "commit_id", "zones", "batches", "changes", "failed", "change_ids"]
+AUDIT_CHANGE_FIELDS=["time", "commit_id", "zone_id", "batch", "change_id", "status", "action", "record", "original"]
+
+
+def flatten_record(data):
+    row = {field: data.get(field, "") for field in OUTPUT_FIELDS}
+    row["Values"] = ",".join(v["Value"] for v in data.get("ResourceRecords", []))
+    row["AliasTarget"] = data.get("AliasTarget", {}).get("DNSName", "")
+    return row
+
+
+def write_rows(rows, output, output_format, fieldnames=None):
+    if output_format == "csv":
+        writer = None
+        for row in rows:
+            if writer is None:
+                writer = csv.DictWriter(output, fieldnames=fieldnames or list(row), extrasaction="ignore")
+                writer.writeheader()
+            writer.writerow({k: json.dumps(v) if isinstance(v, (dict, list)) else v for k, v in row.items()})
+    elif output_format == "jsonl":
+        for row in rows:
+            output.write(json.dumps(row) + "\n")
+    else:
+        separator = "[\n"
+        for row in rows:
+            output.write(separator + json.dumps(row))
+            separator = ",\n"
+        output.write("[]\n" if separator == "[\n" else "\n]\n")
+
+
+def write_records_output(recordset, records, args, updated=False):
+    rows = (recordset.export_record(record, updated=updated) for record in records)
+    if args.format == "csv":
+        rows = (flatten_record(row) for row in rows)
+    write_rows(rows, args.output, args.format, OUTPUT_FIELDS)
+
+
+# Changesets, e.g. for '| r53_record_cli.py apply -'. Their records don't all have the same fields, so csv gets
+# the same flattened columns as list. Only json and jsonl can be applied
+def write_changeset_output(change_records, args):
+    if args.format == "csv":
+        change_records = (flatten_record(data) for data in change_records)
+    write_rows(change_records, args.output, args.format, OUTPUT_FIELDS)
+
+
+_log_event_lock = threading.Lock()
+
+
+# Progress and summaries go to stderr so stdout can be piped. Progress comes from worker threads, so each
+# line is written whole under a lock to keep the stream valid json lines
+def log_event(**event):
+    line = json.dumps(event) + "\n"
+    with _log_event_lock:
+        sys.stderr.write(line)
+        sys.stderr.flush()
+
+
+def command_list(recordset, args):
+    write_records_output(recordset, recordset.select_records(args.policy, args.type), args)
+    return 0
+
+
+def command_filter(recordset, args):
+    write_records_output(recordset, recordset.select_records(args.policy, args.type, args.pattern), args)
+    return 0
+
+
+def command_export(recordset, args):
+    write_records_output(recordset, recordset.original_records, args)
+    return 0
+
+
+def command_set_weight(recordset, args):
+    if args.weight not in range(0, MAX_WEIGHT + 1):
+        log_event(error="weight must be between 0-255")
+        return 2
+    records = recordset.select_records("weighted", args.type, args.pattern)
+    for record in records:
+        record.update("Weight", args.weight)
+    if args.apply:
+        return command_commit(recordset, args)
+    write_records_output(recordset, records, args, updated=True) # the changeset, e.g. for '| r53_record_cli.py apply -'
+    return 0
+
+
+def command_reweight(recordset, args):
+    engine = WeightEngine(recordset.select_records("weighted", args.type, args.pattern))
+    if args.scale is not None:
+        engine.scale(args.scale)
+    elif args.normalize is not None:
+        engine.normalize(args.normalize)
+    else:
+        percent, source, target = args.shift
+        try:
+            percent = parse_percent(percent)
+        except ValueError as e:
+            log_event(error="--shift {0}".format(e))
+            return 2
+        engine.shift(percent, source, target)
+    records = engine.apply()
+    log_event(event="reweight", sets=len(engine.bounds), records=len(engine.records), changed=len(records))
+    if args.apply:
+        return command_commit(recordset, args)
+    write_records_output(recordset, records, args, updated=True)
+    return 0
+
+
+def command_health_checks(recordset, args):
+    recordset.load_health_checks()
+    records = recordset.select_health_checked_records(args.pattern, args.region)
+    action = next((HEALTH_CHECK_ACTIONS[key] for key, flag in (("i", args.invert), ("u", args.uninvert), ("d", args.disable), ("e", args.enable)) if flag), None)
+    if action:
+        recordset.stage_health_checks(records, **action)
+    fields = ["HealthCheckId", "Names", "Inverted", "Disabled", "changes", "status", "error"]
+    if action and args.apply:
+        def progress(result):
+            log_event(event="health_check", health_check_id=result["health_check_id"], status=result["status"])
+        results = {result["health_check_id"]: result for result in recordset.apply_health_checks(progress)}
+    else:
+        results = {}
+    rows = []
+    for health_check_id in sorted({record.HealthCheckId for record in records}):
+        config = recordset.health_checks.get(health_check_id, {}).get("HealthCheckConfig", {})
+        result = results.get(health_check_id, {})
+        rows.append({"HealthCheckId": health_check_id, "Names": sorted({record.Name for record in recordset.get_health_check_records(health_check_id)}),
+                     "Inverted": config.get("Inverted", False), "Disabled": config.get("Disabled", False),
+                     "changes": result.get("changes", recordset.staged_health_checks.get(health_check_id, {})),
+                     "status": result.get("status", "STAGED" if health_check_id in recordset.staged_health_checks else ""), "error": result.get("error")})
+    write_rows(rows, args.output, args.format, fields)
+    return 1 if any(result["status"] == "FAILED" for result in results.values()) else 0
+
+
+def command_diff(recordset, args):
+    base = {}
+    if args.base: # e.g. the _orig changeset written alongside a dumped changeset
+        for data in iter_changeset(get_changeset_path(args.base)):
+            matches = recordset.find_records(data)
+            if len(matches) == 1:
+                base[matches[0].identity] = data
+    entries = iter_diff(recordset, iter_changeset(get_changeset_path(args.changeset)), base)
+    if args.changes_only: # the minimal changeset, which can be piped to apply
+        write_changeset_output((entry["desired"] for entry in entries if entry["status"] == "changed"), args)
+        return 0
+
+    def rows():
+        for entry in entries:
+            desired = entry["desired"]
+            yield {"status": entry["status"], "drifted": bool(entry["drift"]), "HostedZoneId": entry["record"].zone_id if entry["record"] else desired.get("HostedZoneId", ""),
+                   "Name": desired.get("Name"), "Type": desired.get("Type"), "SetIdentifier": desired.get("SetIdentifier", ""),
+                   "changes": {field: list(values) for field, values in entry["fields"].items()},
+                   "drift": {field: list(values) for field, values in entry["drift"].items()}}
+    write_rows(rows(), args.output, args.format, ["status", "drifted", "HostedZoneId", "Name", "Type", "SetIdentifier", "changes", "drift"])
+    return 0
+
+
+def command_apply(recordset, args):
+    results = load_records(recordset, args.changeset)
+    log_event(event="load", matched=len(results["matched"]), unmatched=len(results["unmatched"]), ambiguous=len(results["ambiguous"]))
+    if args.strict and (results["unmatched"] or results["ambiguous"]):
+        log_event(error="changeset has unmatched or ambiguous records, nothing applied")
+        return 1
+    return command_commit(recordset, args)
+
+
+# The validation report as rows, one per problem
+def write_validation_errors(errors, args):
+    write_rows(({"HostedZoneId": error["record"].zone_id, "Name": error["record"].Name, "Type": error["record"].Type, "SetIdentifier": error["record"].get("SetIdentifier", ""),
+                 "field": error["field"], "error": error["error"]} for error in errors), args.output, args.format, VALIDATION_FIELDS)
+
+
+# Check a changeset against the loaded zones without submitting anything
+def command_validate(recordset, args):
+    results = load_records(recordset, args.changeset)
+    log_event(event="load", matched=len(results["matched"]), unmatched=len(results["unmatched"]), ambiguous=len(results["ambiguous"]))
+    errors = recordset.validate_staged()
+    log_event(event="validate", records=len(recordset.get_updated_records()), errors=len(errors))
+    write_validation_errors(errors, args)
+    return 1 if errors else 0
+
+
+# Entries of the audit log, oldest first. Rotated logs are read before the current one, and lines that aren't
+# json (e.g. cut short when the program was killed) are skipped
+def iter_audit_log(path=AUDIT_LOG):
+    for path in ["{0}.{1}".format(path, backup) for backup in range(AUDIT_BACKUPS, 0, -1)] + [path]:
+        if not os.path.exists(path):
+            continue
+        with open(path) as f:
+            for line in f:
+                try:
+                    yield json.loads(line)
+                except ValueError:
+                    continue
+
+
+# Without --commit, one row per commit. With it, the commit's changes, or with --replay/--revert the changeset that
+# makes them again or undoes them, which --apply commits. --commit takes a commit id, one of its change ids or 'last'
+def command_audit(recordset, args):
+    if args.apply and not (args.replay or args.revert):
+        log_event(error="--apply needs --replay or --revert")
+        return 2
+    entries = []
+    statuses = {} # (commit_id, zone_id, batch) -> the last status logged after the batch was submitted
+    for entry in iter_audit_log():
+        if entry.get("event") == "batch_status":
+            statuses[(entry["commit_id"], entry["zone_id"], entry["batch"])] = entry["status"]
+        elif entry.get("event") in ("batch", "change"):
+            entries.append(entry)
+    for entry in entries:
+        entry["status"] = statuses.get((entry["commit_id"], entry["zone_id"], entry["batch"]), entry["status"])
+    if not args.commit:
+        commits = {}
+        for entry in entries:
+            if entry["event"] != "batch":
+                continue
+            commit = commits.setdefault(entry["commit_id"], {"time": entry["time"], "commit_id": entry["commit_id"], "zones": [], "batches": 0, "changes": 0, "failed": 0, "change_ids": []})
+            if entry["zone_id"] not in commit["zones"]:
+                commit["zones"].append(entry["zone_id"])
+            commit["batches"] += 1
+            commit["changes"] += entry["changes"]
+            commit["failed"] += entry["changes"] if entry["status"] == "FAILED" else 0
+            if entry["change_id"]:
+                commit["change_ids"].append(entry["change_id"])
+        write_rows(list(commits.values())[-args.limit:], args.output, args.format, AUDIT_COMMIT_FIELDS)
+        return 0
+
+    commit_id = args.commit
+    if commit_id == "last":
+        commit_id = entries[-1]["commit_id"] if entries else None
+    elif not any(entry["commit_id"] == commit_id for entry in entries):
+        commit_id = next((entry["commit_id"] for entry in entries if entry["change_id"] and entry["change_id"].endswith(commit_id)), None)
+    changes = [entry for entry in entries if entry["event"] == "change" and entry["commit_id"] == commit_id]
+    if not changes:
+        log_event(error="no changes for commit {0} in {1}".format(args.commit, AUDIT_LOG))
+        return 1
+    if not (args.replay or args.revert):
+        write_rows(changes, args.output, args.format, AUDIT_CHANGE_FIELDS)
+        return 0
+
+    # Failed batches changed nothing, so there's nothing in them to replay or revert
+    change_records = [dict(entry["original" if args.revert else "record"], HostedZoneId=entry["zone_id"]) for entry in changes if entry["status"] != "FAILED"]
+    if not args.apply:
+        write_changeset_output(change_records, args)
+        return 0
+    results = stage_change_records(recordset, change_records)
+    log_event(event="load", commit_id=commit_id, matched=len(results["matched"]), unmatched=len(results["unmatched"]), ambiguous=len(results["ambiguous"]))
+    return command_commit(recordset, args)
+
+
+def command_commit(recordset, args):
+    noops = recordset.drop_noop_changes()
+    log_event(event="diff", changes=len(recordset.get_updated_records()), skipped_noops=len(noops))
+    errors = recordset.validate_staged()
+    if errors: # fails before any change batch is sent
+        log_event(error="{0} problems in the staged records, nothing applied".format(len(errors)))
+        write_validation_errors(errors, args)
+        return 1
+    def progress(result):
+        log_event(event="batch", zone_id=result["zone_id"], batch=result["batch"], status=result["status"], change_id=result["change_id"])
+    results = recordset.commit_staged_records(wait=not args.no_wait, progress=progress)
+    fields = ["zone_id", "batch", "changes", "change_id", "status", "error", "elapsed"]
+    write_rows(({"zone_id": r["zone_id"], "batch": r["batch"], "changes": len(r["changes"]), "change_id": r["change_id"], "status": r["status"],
+                 "error": r["error"], "elapsed": r["elapsed"]} for r in results), args.output, args.format, fields)
+    return 1 if any(result["status"] == "FAILED" for result in results) else 0
+
+
+def command_zones(client, args):
+    zones = list_hosted_zones(client)
+    write_rows(({"Id": get_zone_id(zone["Id"]), "Name": zone["Name"], "ResourceRecordSetCount": zone.get("ResourceRecordSetCount", ""),
+                 "PrivateZone": zone.get("Config", {}).get("PrivateZone", "")} for zone in zones), args.output, args.format)
+    return 0
+
+
+def run_command(args):
+    commands = {"list": command_list, "filter": command_filter, "export": command_export,
+                "set-weight": command_set_weight, "reweight": command_reweight, "health-checks": command_health_checks, "diff": command_diff, "apply": command_apply, "validate": command_validate, "audit": command_audit}
+    with contextlib.ExitStack() as stack:
+        args.output = sys.stdout if args.output_file == "-" else stack.enter_context(open(args.output_file, "w", newline=""))
+        if args.command == "zones": # doesn't need any records loaded
+            return command_zones(get_client(), args)
+        if not needs_records(args):
+            return commands[args.command](None, args)
+        cache_ttl = 0 if writes_records(args) else args.cache_ttl # changes are diffed against the live zone, not the cache
+        recordset = RecordSet(zone_ids=args.zone_ids, use_cache=args.use_cache, cache_ttl=cache_ttl, background=False)
+        try:
+            return commands[args.command](recordset, args)
+        finally:
+            log_event(event="api", **get_api_stats())
+
+
+# Listing zones and reading the audit log work without loading any records
+def needs_records(args):
+    return args.command != "zones" and not (args.command == "audit" and not args.apply)
+
+
+def writes_records(args):
+    return args.command == "apply" or (args.command in ("set-weight", "reweight", "audit") and args.apply)
+
+
+# --all-zones discovers every hosted zone in the account, otherwise --zones or the AWS_HOSTED_ZONE_ID env variable
+def get_zone_ids(args):
+    if args.all_zones:
+        return [get_zone_id(zone["Id"]) for zone in list_hosted_zones(get_client())]
+    if args.zones:
+        return [zone_id.strip() for zone_id in args.zones.split(",") if zone_id.strip()]
+    return HOSTED_ZONE_IDS
+
+
+# argparse type for a parse_* function, reporting its ValueError message as the usage error
+def argument_type(parse):
+    def convert(text):
+        try:
+            return parse(text)
+        except ValueError as e:
+            raise argparse.ArgumentTypeError("{0!r}: {1}".format(text, e))
+    return convert
+
+
+def get_parser():
+    parser = argparse.ArgumentParser(description="Edit AWS R53 records")
+    parser.add_argument("-f", metavar="changeset_file", dest="changeset_file", required=False, help="Name of changeset file to apply")
+    parser.add_argument("--no-cache", dest="use_cache", action="store_false", help="Ignore the local record cache and fetch the zone from AWS")
+    parser.add_argument("--cache-ttl", type=int, default=CACHE_TTL, help="Seconds a cached zone snapshot is trusted (default: %(default)s)")
+    parser.add_argument("--zones", help="Comma separated hosted zone ids to load (default: AWS_HOSTED_ZONE_ID)")
+    parser.add_argument("--all-zones", action="store_true", help="Load every hosted zone in the account")
+    parser.add_argument("--profile", action="store_const", const="metrics", default=PROFILE or None, help="Write stage timings, API call counts and latencies to logs/profile-<time>.json (or set R53_PROFILE)")
+    parser.add_argument("--cprofile", dest="profile", action="store_const", const="cprofile", help="--profile plus a cProfile dump in logs/profile-<time>.prof")
+
+    output_options = argparse.ArgumentParser(add_help=False)
+    output_options.add_argument("--format", choices=["json", "jsonl", "csv"], default="json", help="Output format (default: %(default)s)")
+    output_options.add_argument("-o", "--output", dest="output_file", default="-", help="Output file (default: stdout)")
+    record_options = argparse.ArgumentParser(add_help=False)
+    record_options.add_argument("--type", help="Only records of this type, e.g. CNAME")
+    commit_options = argparse.ArgumentParser(add_help=False)
+    commit_options.add_argument("--no-wait", action="store_true", help="Don't wait for changes to reach INSYNC")
+
+    commands = parser.add_subparsers(dest="command", metavar="command", help="Run without a command for the interactive menu")
+    command = commands.add_parser("list", parents=[output_options, record_options], help="List records")
+    command.add_argument("--policy", choices=POLICIES, help="Only records with this routing policy")
+    command = commands.add_parser("filter", parents=[output_options, record_options], help="List records with names matching a pattern")
+    command.add_argument("pattern", help="Substring, glob (*, ?) or '~<regex>'")
+    command.add_argument("--policy", choices=POLICIES, help="Only records with this routing policy")
+    command = commands.add_parser("set-weight", parents=[output_options, record_options, commit_options], help="Set the weight of weighted records matching a pattern")
+    command.add_argument("pattern", help="Substring, glob (*, ?) or '~<regex>'")
+    command.add_argument("weight", type=int, help="New weight (0-255)")
+    command.add_argument("--apply", action="store_true", help="Commit the change instead of printing the changeset")
+    command = commands.add_parser("reweight", parents=[output_options, record_options, commit_options], help="Scale, normalize or shift the weights of each weighted record set matching a pattern")
+    command.add_argument("pattern", help="Substring, glob (*, ?) or '~<regex>'")
+    operation = command.add_mutually_exclusive_group(required=True)
+    operation.add_argument("--scale", type=argument_type(parse_scale), metavar="FACTOR", help="Multiply weights by FACTOR (0 or more)")
+    operation.add_argument("--normalize", type=argument_type(parse_total), nargs="?", const=MAX_WEIGHT, metavar="TOTAL", help="Make each set's weights add up to TOTAL (default 255), keeping their proportions")
+    operation.add_argument("--shift", nargs=3, metavar=("PERCENT", "FROM", "TO"), help="Move PERCENT (0-100) of the weight of records whose SetIdentifier matches FROM to those matching TO")
+    command.add_argument("--apply", action="store_true", help="Commit the change instead of printing the changeset")
+    command = commands.add_parser("health-checks", parents=[output_options], help="List, invert or disable the health checks of latency and failover records")
+    command.add_argument("pattern", nargs="?", help="Substring, glob (*, ?) or '~<regex>' matching record names")
+    command.add_argument("--region", help="Only records whose Region or SetIdentifier matches (substring or glob)")
+    action = command.add_mutually_exclusive_group()
+    action.add_argument("--invert", action="store_true", help="Invert the health checks")
+    action.add_argument("--uninvert", action="store_true", help="Stop inverting the health checks")
+    action.add_argument("--disable", action="store_true", help="Disable the health checks (they are then reported healthy)")
+    action.add_argument("--enable", action="store_true", help="Enable the health checks")
+    command.add_argument("--apply", action="store_true", help="Update the health checks instead of printing the planned changes")
+    command = commands.add_parser("diff", parents=[output_options], help="Compare a changeset with the live zone")
+    command.add_argument("changeset", help="Changeset file, '-' for stdin")
+    command.add_argument("--base", help="Changeset the changes were made against (e.g. <name>_orig.json), to flag records that drifted since")
+    command.add_argument("--changes-only", action="store_true", help="Only write the records that would change, as a changeset")
+    command = commands.add_parser("apply", parents=[output_options, commit_options], help="Apply a changeset")
+    command.add_argument("changeset", help="Changeset file, '-' for stdin")
+    command.add_argument("--strict", action="store_true", help="Apply nothing if any record is unmatched or ambiguous")
+    command = commands.add_parser("validate", parents=[output_options], help="Check a changeset for changes Route53 would reject, without applying it")
+    command.add_argument("changeset", help="Changeset file, '-' for stdin")
+    command = commands.add_parser("audit", parents=[output_options, commit_options], help="List past commits from the audit log, or replay or revert one")
+    command.add_argument("--commit", help="Commit id, one of its change ids or 'last' (default: list the commits)")
+    command.add_argument("--limit", type=int, default=50, help="Most recent commits to list (default: %(default)s)")
+    action = command.add_mutually_exclusive_group()
+    action.add_argument("--replay", action="store_true", help="Write the commit's records as a changeset that makes the changes again")
+    action.add_argument("--revert", action="store_true", help="Write the records from before the commit as a changeset that undoes it")
+    command.add_argument("--apply", action="store_true", help="Commit the replay or revert instead of printing the changeset")
+    commands.add_parser("export", parents=[output_options], help="Export every record in the loaded zones")
+    commands.add_parser("zones", parents=[output_options], help="List the hosted zones in the account")
+    return parser
+
+
+def main(zone_ids=None, use_cache=True, cache_ttl=CACHE_TTL):
+    from rich.prompt import IntPrompt
+
+    recordset = RecordSet(zone_ids=zone_ids, use_cache=use_cache, cache_ttl=cache_ttl)
     quit = False
     while quit != True:
-        main_menu = get_menu_table()
+        recordset.apply_background_refresh()
+        recordset.apply_finished_jobs()
+        main_menu = get_menu_table(recordset)
         display.clear()
         display.update_screen(main_menu)
         menu_choice = IntPrompt.ask("Choose an option")
-    
+        if menu_choice != 0:
+            recordset.wait_for_records()
+            recordset.apply_background_refresh()
+
         if menu_choice == 0:
             display.clear()
             confirm_quit(recordset)
@@ -555,6 +2957,10 @@ def main():
             display.clear()
             load_changeset_from_file(recordset)
 
+        if menu_choice == 6:
+            display.clear()
+            live_traffic_view(recordset)
+
         if menu_choice == 7:
             display.clear()
             get_staged_changes_view(recordset)
@@ -571,24 +2977,73 @@ def main():
             display.clear()
             dump_changesets(recordset)
 
+        if menu_choice == 11:
+            display.clear()
+            get_commit_jobs_view(recordset)
+
+        if menu_choice == 12:
+            display.clear()
+            undo_redo(recordset)
+
+        if menu_choice == 13:
+            display.clear()
+            undo_redo(recordset, redo=True)
+
+        if menu_choice == 14:
+            display.clear()
+            edit_health_checks(recordset)
+
         if menu_choice == 99:
             refresh_record_cache(recordset)
     
     display.clear()
     display.end_screen()
 
+# Collect metrics for the rest of the run and write them when it ends, however it ends
+def start_profiling(mode):
+    global metrics
+    import atexit
+    metrics = Metrics()
+    path = time.strftime("logs/profile-%Y%m%d-%H%M%S")
+    profiler = None
+    if mode == "cprofile": # only profiles the main thread, fetch and commit workers show up as waits
+        import cProfile
+        profiler = cProfile.Profile()
+        profiler.enable()
+
+    def write_profile():
+        if profiler:
+            profiler.disable()
+            profiler.dump_stats(path + ".prof")
+        metrics.write(path + ".json")
+        print("Profile written to {0}.json".format(path), file=sys.stderr)
+    atexit.register(write_profile)
+
+
 if __name__=="__main__":
-    parser = argparse.ArgumentParser(description="Edit AWS R53 records")
-    parser.add_argument("-f", metavar="changeset_file", dest="changeset_file", required=False, help="Name of changeset file to apply")
+    args = get_parser().parse_args()
+    configure_logging()
+    if args.profile:
+        start_profiling(args.profile)
+
+    if needs_records(args):
+        args.zone_ids = get_zone_ids(args)
+        if not args.zone_ids:
+            print("'AWS_HOSTED_ZONE_ID' env variable (or --zones / --all-zones) must be set")
+            sys.exit(1)
+
+    if args.command:
+        sys.exit(run_command(args))
 
-    args = parser.parse_args()
+    from rich.traceback import install
+    install()
 
     changeset_file = args.changeset_file
 
     if changeset_file:
         display = Display()
-        recordset = RecordSet()
+        recordset = RecordSet(zone_ids=args.zone_ids, use_cache=args.use_cache, cache_ttl=0, background=False) # always the live zone
         unattended_apply(recordset, changeset_file)
 
     display = Display()
-    main()
+    main(zone_ids=args.zone_ids, use_cache=args.use_cache, cache_ttl=args.cache_ttl)